@@ -84,6 +84,9 @@ ADMIN_GROUP_ID = -0000000000000  # Replace with the actual admin group chat ID
 # Dictionary to store the user pairs in memory
 user_pairs = {}
 
+# Dictionary to store the chat_pairs row id of each user's current session
+pair_sessions = {}
+
 # List to store waiting users
 waiting_users = []
 
@@ -234,10 +237,12 @@ async def connect(update: Update, context: CallbackContext) -> None:
 
         # Save chat pair to the database
         with conn:
-            conn.execute(
+            cursor = conn.execute(
                 "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)",
                 (user_id, partner_id)
             )
+        pair_sessions[user_id] = cursor.lastrowid
+        pair_sessions[partner_id] = cursor.lastrowid
 
         await update.message.reply_text('You are now connected to a chat partner. Type /disconnect to end the chat.')
         await context.bot.send_message(partner_id, 'You are now connected to a chat partner. Type /disconnect to end the chat.')
@@ -255,12 +260,14 @@ async def disconnect(update: Update, context: CallbackContext) -> None:
 
     partner_id = user_pairs.pop(user_id)
     user_pairs.pop(partner_id)
+    pair_id = pair_sessions.pop(user_id)
+    pair_sessions.pop(partner_id)
 
     # Update disconnect time in the database
     with conn:
         conn.execute(
-            "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-            (user_id, partner_id, partner_id, user_id)
+            "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (pair_id,)
         )
 
     await update.message.reply_text('You have been disconnected.')
@@ -275,6 +282,7 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
         return
 
     partner_id = user_pairs[user_id]
+    pair_id = pair_sessions[user_id]
 
     if update.message.text:
         message = update.message.text
@@ -283,11 +291,6 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
 
         # Save message to the database
         with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
             conn.execute(
                 "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
                 (pair_id, user_id, message, media_type, media_id)
@@ -302,11 +305,6 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
 
         # Save photo to the database
         with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
             conn.execute(
                 "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
                 (pair_id, user_id, message, media_type, media_id)
@@ -321,11 +319,6 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
 
         # Save video to the database
         with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
             conn.execute(
                 "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
                 (pair_id, user_id, message, media_type, media_id)
@@ -340,11 +333,6 @@ async def message_handler(update: Update, context: CallbackContext) -> None:
 
         # Save animation (GIF) to the database
         with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
             conn.execute(
                 "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
                 (pair_id, user_id, message, media_type, media_id)
@@ -1,7 +1,34 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
+import gzip
+import heapq
+import itertools
+import json
 import logging
+import math
+import operator
+import os
+import pathlib
+import random
 import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+import sys
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio, InputMediaDocument, InputMediaPhoto,
+    InputMediaVideo, TelegramObject,
+)
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import (
+    Application, ApplicationHandlerStop, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, TypeHandler,
+    filters, CallbackContext, CallbackQueryHandler,
+)
 from datetime import datetime, timedelta
 
 # Enable logging
@@ -12,21 +39,382 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Database connections
-conn = sqlite3.connect('telegram_bot.db', check_same_thread=False)
-sudo_conn = sqlite3.connect('sudo_users.db', check_same_thread=False)
-report_conn = sqlite3.connect('reports.db', check_same_thread=False)
+# Metrics endpoint, served in the Prometheus text format at http://METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9464  # None disables the endpoint; metrics are still collected. Give each worker process its own port
+METRICS_PREFIX = 'randomtalker_'
+
+# Histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    """Monotonic count per label set."""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, format_labels(self.labels, label_values), value) for label_values, value in values]
+
+class Histogram:
+    """Distribution of observed values per label set, in cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """Observe how long the with block takes."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+        samples = []
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', format_labels(self.labels, label_values, [('le', bound)]), cumulative))
+            samples.append((f'{self.name}_count', format_labels(self.labels, label_values), cumulative))
+            samples.append((f'{self.name}_sum', format_labels(self.labels, label_values), counts[-1]))
+        return samples
+
+class Gauge:
+    """Value read when metrics are collected, from a function that may be a coroutine function."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.value = 0
+
+    def samples(self):
+        return [(self.name, '', self.value)]
+
+class MetricsRegistry:
+    """Every metric the bot exports, rendered in the Prometheus text format."""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self.prefix + name, help, labels, buckets))
+
+    def gauge(self, name, help, read):
+        return self._register(Gauge(self.prefix + name, help, read))
+
+    async def render(self):
+        lines = []
+        for metric in self._metrics:
+            if isinstance(metric, Gauge):
+                try:
+                    value = metric.read()
+                    metric.value = await value if asyncio.iscoroutine(value) else value
+                except Exception:
+                    logger.exception("Failed to read gauge %s", metric.name)
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(f'{name}{labels} {value}' for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry(METRICS_PREFIX)
+handler_seconds = metrics.histogram('handler_duration_seconds', 'Time spent in each update handler.', ('handler',))
+handler_errors = metrics.counter('handler_errors_total', 'Exceptions raised by each update handler.', ('handler',))
+sqlite_seconds = metrics.histogram(
+    'sqlite_duration_seconds', 'Time spent running SQLite work, per connection and kind (read, write or commit).',
+    ('connection', 'kind'), DB_BUCKETS
+)
+api_seconds = metrics.histogram('api_request_duration_seconds', 'Latency of Bot API calls, per method.', ('method',))
+api_errors = metrics.counter('api_errors_total', 'Failed Bot API calls, per method and error.', ('method', 'error'))
+api_retries = metrics.counter('api_retries_total', 'Bot API calls retried after a flood wait or network error.', ('method',))
+dead_lettered = metrics.counter('dead_letters_total', 'Sends given up on and recorded in dead_letters.', ('method',))
+
+# Profiling settings
+PROFILE_UPDATES = False  # Split every handler's time into database and Bot API time, and log slow updates
+SLOW_UPDATE_SECONDS = 1.0  # With PROFILE_UPDATES, updates handled slower than this are logged with a breakdown
+PROFILE_DIR = 'profiles'  # Where /profile writes the stacks it sampled
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between two stack samples
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+
+class UpdateProfile:
+    """Time one handler call spent waiting for the database and for the Bot API."""
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.db_calls = 0
+        self.api_time = 0.0
+        self.api_calls = 0
+
+# Profile of the handler call running in the current task, set while PROFILE_UPDATES is on
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+handler_db_seconds = metrics.histogram(
+    'handler_db_seconds', 'Time each handler spent waiting for the database (with PROFILE_UPDATES).', ('handler',)
+)
+handler_api_seconds = metrics.histogram(
+    'handler_api_seconds', 'Time each handler spent waiting for the Bot API (with PROFILE_UPDATES).', ('handler',)
+)
 
-# Create tables if they do not exist in 'telegram_bot.db'
-with conn:
-    conn.execute('''
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request to the metrics endpoint."""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1].split(b'?')[0] == b'/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', (await metrics.render()).encode()
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+# SQLite tuning applied to every connection
+DB_PRAGMAS = {
+    'synchronous': 'NORMAL',  # Safe with WAL; commits no longer fsync the main database file
+    'cache_size': -20000,  # Page cache size in KiB (negative) per connection
+    'mmap_size': 268435456,  # Memory-map up to 256 MiB of the database file
+    'busy_timeout': 5000,  # Milliseconds to wait for a lock before raising
+    'temp_store': 'MEMORY',
+}
+DB_READ_POOL_SIZE = min(8, (os.cpu_count() or 1) + 1)  # Read-only connections per database
+
+class Database:
+    """Run all sqlite3 work for one database file off the event loop.
+
+    The database is opened in WAL mode. Every write is serialized through a
+    single writer connection on its own thread, while reads run on a pool of
+    read-only connections so they never wait behind a commit. Coroutines
+    await the methods below instead of touching a connection directly.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'sqlite-writer-{path}')
+        self._read_executor = ThreadPoolExecutor(max_workers=DB_READ_POOL_SIZE, thread_name_prefix=f'sqlite-reader-{path}')
+        self._read_local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        self.conn = self._executor.submit(self._open_writer).result()
+
+    def _configure(self, conn):
+        for name, value in DB_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+
+    def _open_writer(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        self._configure(conn)
+        return conn
+
+    def _reader(self):
+        # Each pool thread lazily opens its own read-only connection
+        conn = getattr(self._read_local, 'conn', None)
+        if conn is None:
+            uri = pathlib.Path(self.path).resolve().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._configure(conn)
+            self._read_local.conn = conn
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def call(self, func, *args):
+        """Run func(conn, *args) on the writer thread and wait for the result."""
+        return self._executor.submit(func, self.conn, *args).result()
+
+    def _timed(self, kind, func, conn, *args):
+        # Runs on the connection's thread, so the time excludes waiting for the thread
+        with sqlite_seconds.time(threading.current_thread().name, kind):
+            return func(conn, *args)
+
+    def _commit(self, conn):
+        with sqlite_seconds.time(threading.current_thread().name, 'commit'):
+            conn.commit()
+
+    async def run(self, func, *args):
+        """Run func(conn, *args) on the writer thread without blocking the loop."""
+        loop = asyncio.get_running_loop()
+        return await self._profiled(loop.run_in_executor(self._executor, self._timed, 'write', func, self.conn, *args))
+
+    async def read(self, func, *args):
+        """Run func(conn, *args) on a pooled read-only connection."""
+        loop = asyncio.get_running_loop()
+        return await self._profiled(loop.run_in_executor(self._read_executor, lambda: self._timed('read', func, self._reader(), *args)))
+
+    @staticmethod
+    async def _profiled(future):
+        # Charges the wait, including time queued behind other work, to the running handler
+        profile = current_profile.get()
+        if profile is None:
+            return await future
+        started = time.perf_counter()
+        try:
+            return await future
+        finally:
+            profile.db_time += time.perf_counter() - started
+            profile.db_calls += 1
+
+    async def transaction(self, func, *args):
+        """Run func(conn, *args) inside a single write transaction."""
+        def run_in_transaction(conn, *args):
+            try:
+                result = func(conn, *args)
+            except BaseException:
+                conn.rollback()
+                raise
+            self._commit(conn)
+            return result
+        return await self.run(run_in_transaction, *args)
+
+    async def immediate_transaction(self, func, *args):
+        """Run func(conn, *args) inside a transaction that takes the write lock up front.
+
+        Use this for read-then-write transactions that other processes may run
+        concurrently, so they wait for the lock instead of failing to upgrade.
+        """
+        def run_in_transaction(conn, *args):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(conn, *args)
+            except BaseException:
+                conn.rollback()
+                raise
+            self._commit(conn)
+            return result
+        return await self.run(run_in_transaction, *args)
+
+    async def execute(self, sql, params=()):
+        """Execute a write statement and return the last inserted row id."""
+        return await self.transaction(lambda conn: conn.execute(sql, params).lastrowid)
+
+    async def executemany(self, sql, seq_of_params):
+        """Execute a write statement for every parameter set in one transaction."""
+        await self.transaction(lambda conn: conn.executemany(sql, seq_of_params))
+
+    async def fetchone(self, sql, params=()):
+        """Return the first row of a query."""
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        """Return all rows of a query."""
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        """Close every connection and stop the database threads."""
+        self._read_executor.shutdown()
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+        self.call(lambda conn: conn.close())
+        self._executor.shutdown()
+
+# Databases used before everything was consolidated into 'telegram_bot.db',
+# with the tables each of them held
+LEGACY_DATABASES = {
+    'sudo_users.db': ['sudo_users'],
+    'reports.db': ['reports'],
+}
+
+def import_legacy_databases(conn):
+    """Copy the rows of the legacy database files into the main database."""
+    for path, tables in LEGACY_DATABASES.items():
+        if not os.path.exists(path):
+            continue
+        legacy = sqlite3.connect(path)
+        try:
+            for table in tables:
+                if legacy.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None:
+                    continue
+                cursor = legacy.execute(f"SELECT * FROM {table}")
+                columns = [column[0] for column in cursor.description]
+                placeholders = ', '.join('?' for _ in columns)
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                    cursor
+                )
+        finally:
+            legacy.close()
+        logger.info("Imported %s from %s; the file is no longer used and can be removed", ', '.join(tables), path)
+
+# Schema migrations, applied in order. A step is either an SQL statement or a
+# callable that receives the connection.
+# PRAGMA user_version records how many of them the database has already applied,
+# so append new migrations to the end and never edit one that has shipped.
+MIGRATIONS = [
+    # 1: initial schema
+    [
+        '''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    conn.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS chat_pairs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user1_id INTEGER NOT NULL,
@@ -34,8 +422,8 @@ with conn:
             connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             disconnected_at TIMESTAMP
         )
-    ''')
-    conn.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             pair_id INTEGER NOT NULL,
@@ -46,27 +434,30 @@ with conn:
             sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (pair_id) REFERENCES chat_pairs(id)
         )
-    ''')
-    conn.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS banned_users (
             user_id INTEGER PRIMARY KEY,
             reason TEXT,
             banned_until TIMESTAMP
         )
-    ''')
-
-# Create tables if they do not exist in 'sudo_users.db'
-with sudo_conn:
-    sudo_conn.execute('''
+        ''',
+    ],
+    # 2: indexes for pair lookups and per-session message history
+    [
+        "CREATE INDEX IF NOT EXISTS idx_chat_pairs_users ON chat_pairs (user1_id, user2_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_pair_sent ON messages (pair_id, sent_at)",
+    ],
+    # 3: move sudo_users and reports into this database so moderation actions
+    # that touch several tables commit as one transaction
+    [
+        '''
         CREATE TABLE IF NOT EXISTS sudo_users (
             user_id INTEGER PRIMARY KEY,
             username TEXT
         )
-    ''')
-
-# Create tables if they do not exist in 'reports.db'
-with report_conn:
-    report_conn.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS reports (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             reporter_id INTEGER,
@@ -75,24 +466,1479 @@ with report_conn:
             media_id TEXT,
             status TEXT DEFAULT 'pending'
         )
-    ''')
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_reports_status ON reports (status)",
+        "CREATE INDEX IF NOT EXISTS idx_reports_reported ON reports (reported_id)",
+        import_legacy_databases,
+    ],
+    # 4: live matchmaking state shared between worker processes (STATE_BACKEND = 'sqlite')
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS live_waiting (
+            user_id INTEGER PRIMARY KEY,
+            since REAL NOT NULL,
+            tagged INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_live_waiting_since ON live_waiting (since)",
+        "CREATE INDEX IF NOT EXISTS idx_live_waiting_tagged ON live_waiting (tagged, since)",
+        '''
+        CREATE TABLE IF NOT EXISTS live_waiting_tags (
+            tag TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            since REAL NOT NULL,
+            PRIMARY KEY (tag, user_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_live_waiting_tags_since ON live_waiting_tags (tag, since)",
+        "CREATE INDEX IF NOT EXISTS idx_live_waiting_tags_user ON live_waiting_tags (user_id)",
+        '''
+        CREATE TABLE IF NOT EXISTS live_pairs (
+            user_id INTEGER PRIMARY KEY,
+            partner_id INTEGER NOT NULL,
+            pair_id INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_live_pairs_pair ON live_pairs (pair_id)",
+    ],
+    # 5: sends that failed for good, kept for admins to inspect and replay
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            endpoint TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            error TEXT,
+            attempts INTEGER NOT NULL,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            replayed_at TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_dead_letters_pending ON dead_letters (replayed_at, id)",
+    ],
+    # 6: message retention. Reports remember the chat they were filed from so
+    # its messages are kept while the report is pending, and chat_pairs records
+    # when a session's messages were archived and purged.
+    [
+        "ALTER TABLE reports ADD COLUMN pair_id INTEGER",
+        '''
+        UPDATE reports SET pair_id = (
+            SELECT MAX(id) FROM chat_pairs
+            WHERE (user1_id = reports.reporter_id AND user2_id = reports.reported_id)
+               OR (user1_id = reports.reported_id AND user2_id = reports.reporter_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_reports_pending_pair ON reports (pair_id) WHERE status = 'pending'",
+        "ALTER TABLE chat_pairs ADD COLUMN archived_at TIMESTAMP",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_chat_pairs_unarchived ON chat_pairs (disconnected_at)
+        WHERE archived_at IS NULL AND disconnected_at IS NOT NULL
+        ''',
+    ],
+    # 7: open sessions, read when live pairs are rebuilt after a restart
+    [
+        "CREATE INDEX IF NOT EXISTS idx_chat_pairs_open ON chat_pairs (id) WHERE disconnected_at IS NULL",
+    ],
+    # 8: when each live pair last relayed a message, for ending idle chats
+    [
+        "ALTER TABLE live_pairs ADD COLUMN last_active REAL",
+        "UPDATE live_pairs SET last_active = CAST(strftime('%s', 'now') AS REAL)",
+    ],
+    # 9: one card per reported user in the admin group, edited as reports come in
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS report_cards (
+            reported_id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL,
+            last_report_id INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_reports_pending_reported ON reports (reported_id, reporter_id) WHERE status = 'pending'",
+    ],
+    # 10: archived_at is now set as soon as a chat's archive file is written and
+    # purged_at once its messages are deleted, so an interrupted purge is
+    # finished without archiving the chat again. Chats archived before this
+    # were purged in the same step.
+    [
+        "ALTER TABLE chat_pairs ADD COLUMN purged_at TIMESTAMP",
+        "UPDATE chat_pairs SET purged_at = archived_at WHERE archived_at IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_chat_pairs_unpurged ON chat_pairs (id) WHERE archived_at IS NOT NULL AND purged_at IS NULL",
+    ],
+]
+
+def migrate(conn, migrations):
+    """Apply every migration newer than the database's user_version.
+
+    Each migration runs in its own transaction together with the version bump,
+    so an interrupted upgrade resumes from the last migration that completed.
+    The initial schema uses IF NOT EXISTS, which lets databases created before
+    versioning existed start at version 0 and upgrade in place.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(migrations[version:], start=version + 1):
+        conn.execute("BEGIN")
+        try:
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        conn.commit()
+        logger.info("Applied schema migration %d", number)
+
+# Database connection
+db = Database('telegram_bot.db')
+
+# Bring the database up to the current schema before the bot starts
+db.call(migrate, MIGRATIONS)
 
 # Bot owner ID
 BOT_OWNER_ID = 123456789  # Replace with the actual bot owner's Telegram user ID
 ADMIN_GROUP_ID = -1001234567890  # Replace with the actual admin group chat ID
 
-# Dictionary to store the user pairs in memory
-user_pairs = {}
+# Bot API settings
+BOT_TOKEN = "YOUR_TOKEN_HERE"  # Replace with your bot's token
+BOT_API_BASE_URL = "https://api.telegram.org/bot"  # Point this at a local Bot API stand-in for testing
+
+# How the bot receives updates: 'polling' (getUpdates) or 'webhook' (Telegram pushes them to a local HTTP server)
+UPDATE_MODE = 'polling'
+UPDATE_QUEUE_SIZE = 1000  # Updates received but not yet picked up; intake waits once the queue is full
+UPDATE_CONCURRENCY = 64  # Updates handled at the same time; each chat's and each pair's updates still run one at a time
+WEBHOOK_LISTEN = '127.0.0.1'  # Address of the local webhook server, usually behind a TLS-terminating reverse proxy
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_URL = 'https://example.com/telegram'  # Replace with the public URL that forwards to the webhook server
+WEBHOOK_SECRET_TOKEN = 'replace-with-a-random-secret'  # Replace with 1-256 characters of A-Z, a-z, 0-9, _ and -
+WEBHOOK_MAX_CONNECTIONS = 40  # Concurrent connections Telegram may open to the webhook server
+
+# Outbound rate limits, kept just under Telegram's flood limits
+SEND_GLOBAL_RATE = 30  # Messages per second across all chats
+SEND_CHAT_RATE = 1  # Messages per second to one private chat
+SEND_CHAT_BURST = 3  # Messages a private chat can receive back to back before the rate applies
+SEND_GROUP_RATE = 20 / 60  # Messages per second to one group, such as ADMIN_GROUP_ID
+SEND_GROUP_BURST = 3
+SEND_BUCKET_IDLE_SECONDS = 60  # Forget the bucket of a chat nothing has been sent to for this long
+# Bot processes sending for this bot token at once (see STATE_BACKEND). Token buckets are kept
+# per process while Telegram's limits are per bot, so each process takes an equal share of the
+# global and group limits. A private chat's sends usually come from the process handling its
+# pair's updates and keep the full per-chat rate.
+SEND_WORKER_PROCESSES = 1
+
+# Outbound priorities, lowest value sent first. Pass one as rate_limit_args to any bot method;
+# sends to private chats default to PRIORITY_RELAY and sends to groups to PRIORITY_ADMIN.
+PRIORITY_RELAY = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+
+# Bot API methods that count against the flood limits
+RATE_LIMITED_METHODS = ('send', 'copyMessage', 'forwardMessage', 'editMessage')
+
+# Delivery retries
+SEND_MAX_RETRIES = 5  # Retries after a flood wait or a network error before a send is given up
+SEND_RETRY_BASE_DELAY = 0.5  # Seconds before the first retry after a network error, doubled on each retry
+SEND_RETRY_MAX_DELAY = 30  # Longest backoff between two retries
+DEAD_LETTER_METHODS = ('send', 'copyMessage', 'forwardMessage')  # Sends recorded in dead_letters when they fail
+DEAD_LETTER_LIST_LIMIT = 10  # Dead letters shown by /deadletters
+
+# Set while an admin replays a dead letter, so a failed replay is not recorded again
+replaying_dead_letter = contextvars.ContextVar('replaying_dead_letter', default=False)
+
+def to_json_payload(value):
+    """Convert API call parameters into plain JSON-compatible values."""
+    if isinstance(value, TelegramObject):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [to_json_payload(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_json_payload(item) for key, item in value.items() if item is not None}
+    return value
+
+async def record_dead_letter(chat_id, endpoint, data, error, attempts):
+    """Store a send that could not be delivered."""
+    try:
+        await db.execute(
+            "INSERT INTO dead_letters (chat_id, endpoint, payload, error, attempts) VALUES (?, ?, ?, ?, ?)",
+            (chat_id if isinstance(chat_id, int) else None, endpoint,
+             json.dumps(to_json_payload(data), default=str), f"{type(error).__name__}: {error}", attempts)
+        )
+    except sqlite3.Error:
+        logger.exception("Failed to record dead letter for %s to %s", endpoint, chat_id)
+
+def retry_delay(attempt):
+    """Return the jittered exponential backoff before retry number attempt."""
+    delay = min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.5)
+
+class TokenBucket:
+    """Token bucket that refills at rate tokens per second up to capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Return how many seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate-limit, prioritise and retry every outgoing Bot API call."""
+
+    def __init__(self):
+        global_rate = SEND_GLOBAL_RATE / SEND_WORKER_PROCESSES
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._chats = {}  # chat_id -> deque of (priority, future, enqueued_at)
+        self._ready = []  # heap of (priority, seq, chat_id) for chats whose next send can go now
+        self._delayed = []  # heap of (ready_at, priority, seq, chat_id) for chats out of tokens
+        self._scheduled = set()  # chats with an entry in _ready or _delayed
+        self._busy = set()  # chats with a send in flight
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._last_prune = time.monotonic()
+        self.queued = collections.Counter()  # priority -> sends waiting for their turn
+        self.wait_times = collections.deque(maxlen=1000)  # seconds recent sends waited for their turn
+
+    async def initialize(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        profile = current_profile.get()
+        if profile is None:
+            return await self._process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+        # Charges the whole call, including the wait for a send slot, to the running handler
+        started = time.perf_counter()
+        try:
+            return await self._process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+        finally:
+            profile.api_time += time.perf_counter() - started
+            profile.api_calls += 1
+
+    async def _process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None or not endpoint.startswith(RATE_LIMITED_METHODS):
+            return await self._call(callback, args, kwargs, endpoint)
+
+        with contextlib.suppress(TypeError, ValueError):
+            chat_id = int(chat_id)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        elif self._is_group(chat_id):
+            priority = PRIORITY_ADMIN
+        else:
+            priority = PRIORITY_RELAY
+
+        await self._acquire(chat_id, priority)
+        try:
+            return await self._deliver(callback, args, kwargs, endpoint, data, chat_id)
+        finally:
+            self._release(chat_id)
+
+    @staticmethod
+    async def _call(callback, args, kwargs, endpoint):
+        if endpoint == 'getUpdates':
+            # Long polls wait for updates on purpose; timing them says nothing about the API
+            return await callback(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as exc:
+            api_errors.inc(endpoint, type(exc).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, endpoint)
+
+    async def _deliver(self, callback, args, kwargs, endpoint, data, chat_id):
+        # Retries keep the chat's turn, so later sends to the same chat cannot overtake them
+        attempt = 0
+        while True:
+            try:
+                return await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as exc:
+                if attempt >= SEND_MAX_RETRIES:
+                    error = exc
+                    break
+                retry_after = exc.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                delay = retry_after + random.uniform(0.1, 1.0)
+                logger.warning("Flood limit hit sending %s to %s, retrying in %.1fs", endpoint, chat_id, delay)
+            except (Forbidden, BadRequest) as exc:
+                # The bot was blocked or the request is invalid: retrying cannot help
+                error = exc
+                break
+            except NetworkError as exc:
+                if attempt >= SEND_MAX_RETRIES:
+                    error = exc
+                    break
+                delay = retry_delay(attempt)
+                logger.warning("Network error sending %s to %s (%s), retrying in %.1fs", endpoint, chat_id, exc, delay)
+            attempt += 1
+            api_retries.inc(endpoint)
+            await asyncio.sleep(delay)
+
+        logger.warning("Giving up on %s to %s after %d attempts: %s", endpoint, chat_id, attempt + 1, error)
+        if endpoint.startswith(DEAD_LETTER_METHODS) and not replaying_dead_letter.get():
+            dead_lettered.inc(endpoint)
+            await record_dead_letter(chat_id, endpoint, data, error, attempt + 1)
+        raise error
+
+    def stats(self):
+        """Return the queue depth per priority, sends in flight and recent wait times."""
+        waits = sorted(self.wait_times)
+        return {
+            'queued': dict(self.queued),
+            'in_flight': len(self._busy),
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+    @staticmethod
+    def _is_group(chat_id):
+        # Group and channel IDs are negative; usernames only work for channels and supergroups
+        return isinstance(chat_id, str) or chat_id < 0
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if self._is_group(chat_id):
+                bucket = TokenBucket(SEND_GROUP_RATE / SEND_WORKER_PROCESSES, max(1, SEND_GROUP_BURST // SEND_WORKER_PROCESSES))
+            else:
+                bucket = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule(self, chat_id):
+        # Queue the chat's next send for dispatch unless it already is, or a send is in flight
+        waiting = self._chats.get(chat_id)
+        if not waiting or chat_id in self._scheduled or chat_id in self._busy:
+            return
+        heapq.heappush(self._ready, (waiting[0][0], next(self._seq), chat_id))
+        self._scheduled.add(chat_id)
+        self._wakeup.set()
+
+    async def _acquire(self, chat_id, priority):
+        future = asyncio.get_running_loop().create_future()
+        self._chats.setdefault(chat_id, collections.deque()).append((priority, future, time.monotonic()))
+        self.queued[priority] += 1
+        self._schedule(chat_id)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Cancelled after being granted the turn: hand it back
+                self._release(chat_id)
+            raise
+
+    def _release(self, chat_id):
+        self._busy.discard(chat_id)
+        self._schedule(chat_id)
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def _prune(self, now):
+        for chat_id in [chat_id for chat_id, waiting in self._chats.items() if not waiting]:
+            if chat_id not in self._busy and chat_id not in self._scheduled:
+                del self._chats[chat_id]
+        for chat_id in [chat_id for chat_id in self._buckets if chat_id not in self._chats]:
+            if chat_id not in self._busy and self._buckets[chat_id].is_full(now):
+                del self._buckets[chat_id]
+        self._last_prune = now
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if now - self._last_prune > SEND_BUCKET_IDLE_SECONDS:
+                self._prune(now)
+
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+
+            if not self._ready:
+                await self._wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            bucket = self._bucket(chat_id)
+            chat_delay = bucket.delay(now)
+            if chat_delay > 0:
+                heapq.heappush(self._delayed, (now + chat_delay, priority, seq, chat_id))
+                continue
+
+            self._scheduled.discard(chat_id)
+            priority, future, enqueued_at = self._chats[chat_id].popleft()
+            self.queued[priority] -= 1
+            if future.cancelled():
+                self._schedule(chat_id)
+                continue
+
+            self._global.take(now)
+            bucket.take(now)
+            self._busy.add(chat_id)
+            self.wait_times.append(now - enqueued_at)
+            future.set_result(None)
+
+# Scheduler every outgoing Bot API call goes through
+outbox = OutboundScheduler()
+
+# Matchmaking settings
+MAX_MATCH_TAGS = 5  # Maximum number of interest/language tags per /connect
+MAX_TAG_LENGTH = 32
+MATCH_CANDIDATES_PER_TAG = 20  # Longest-waiting users examined per tag when looking for the best overlap
+MATCH_FALLBACK_SECONDS = 60  # A user with tags is matched with anyone after waiting this long (None disables)
+MATCH_FALLBACK_INTERVAL = 5  # Seconds between passes that pair users past the fallback threshold
+
+def parse_tags(args):
+    """Normalize the tags given to /connect."""
+    tags = []
+    for arg in args:
+        tag = arg.lower().lstrip('#')[:MAX_TAG_LENGTH]
+        if tag and tag not in tags:
+            tags.append(tag)
+    return frozenset(tags[:MAX_MATCH_TAGS])
+
+class MatchQueue:
+    """First-in, first-out queue of users waiting for a chat partner.
+
+    Backed by ordered dicts, so adding, cancelling and matching are O(1) in
+    the number of waiting users and a user can only be queued once. An
+    inverted index from tag to waiting users lets a user with tags find the
+    partner with the most tags in common by examining only the longest-waiting
+    few users of each of their tags. Users without tags are matched with
+    other users without tags, or with anyone who has waited longer than
+    fallback_after seconds.
+    """
+
+    def __init__(self, fallback_after=MATCH_FALLBACK_SECONDS):
+        self.fallback_after = fallback_after
+        self._waiting = OrderedDict()  # user_id -> (time the user started waiting, tags)
+        self._untagged = OrderedDict()  # user_id -> None, for users without tags
+        self._by_tag = {}  # tag -> OrderedDict of user_id -> None
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, user_id):
+        return user_id in self._waiting
+
+    def add(self, user_id, tags=frozenset(), since=None):
+        """Queue a user. Return False if they are already waiting.
+
+        since is the time.monotonic() value the user started waiting at and
+        defaults to now. Users must be added in the order they started waiting.
+        """
+        if user_id in self._waiting:
+            return False
+        self._waiting[user_id] = (time.monotonic() if since is None else since, tags)
+        if tags:
+            for tag in tags:
+                self._by_tag.setdefault(tag, OrderedDict())[user_id] = None
+        else:
+            self._untagged[user_id] = None
+        return True
+
+    def remove(self, user_id):
+        """Take a user out of the queue. Return False if they were not waiting."""
+        entry = self._waiting.pop(user_id, None)
+        if entry is None:
+            return False
+        tags = entry[1]
+        if tags:
+            for tag in tags:
+                waiting = self._by_tag[tag]
+                del waiting[user_id]
+                if not waiting:
+                    del self._by_tag[tag]
+        else:
+            del self._untagged[user_id]
+        return True
+
+    def waiting_since(self, user_id):
+        """Return the time.monotonic() value the user started waiting at, or None if they are not waiting."""
+        entry = self._waiting.get(user_id)
+        return entry[0] if entry is not None else None
+
+    def entries(self):
+        """Yield (user_id, since, tags) for every waiting user, longest-waiting first."""
+        for user_id, (since, tags) in self._waiting.items():
+            yield user_id, since, tags
+
+    def pop_partner(self, user_id, tags=frozenset()):
+        """Remove and return the best partner for user_id, or None.
+
+        A user with tags gets the waiting user with the most tags in common,
+        the longest-waiting one on ties. A user without tags gets the
+        longest-waiting user who accepts anyone.
+        """
+        if tags:
+            partner_id = self._best_overlap(user_id, tags)
+        else:
+            partner_id = self._first_fallback(exclude=(user_id,))
+        if partner_id is not None:
+            self.remove(partner_id)
+        return partner_id
+
+    def pop_fallback_pair(self):
+        """Remove and return two users who have both waited past the fallback threshold, or None.
+
+        A user without tags counts as having passed the threshold already.
+        """
+        first_id = self._first_expired()
+        if first_id is None:
+            return None
+        partner_id = self._first_fallback(exclude=(first_id,))
+        if partner_id is None:
+            return None
+        self.remove(first_id)
+        self.remove(partner_id)
+        return first_id, partner_id
+
+    def _best_overlap(self, user_id, tags):
+        overlap = {}
+        for tag in tags:
+            for candidate_id in itertools.islice(self._by_tag.get(tag, ()), MATCH_CANDIDATES_PER_TAG + 1):
+                if candidate_id != user_id:
+                    overlap[candidate_id] = overlap.get(candidate_id, 0) + 1
+        if not overlap:
+            return None
+        return max(overlap, key=lambda candidate_id: (overlap[candidate_id], -self._waiting[candidate_id][0]))
+
+    def _first_expired(self, exclude=()):
+        # Users are kept in the order they started waiting, so stop at the first one who has not expired
+        if self.fallback_after is None:
+            return None
+        deadline = time.monotonic() - self.fallback_after
+        for candidate_id, (since, _) in self._waiting.items():
+            if since > deadline:
+                return None
+            if candidate_id not in exclude:
+                return candidate_id
+        return None
+
+    def _first_untagged(self, exclude=()):
+        for candidate_id in self._untagged:
+            if candidate_id not in exclude:
+                return candidate_id
+        return None
+
+    def _first_fallback(self, exclude=()):
+        # The longest-waiting user who accepts anyone
+        candidates = [
+            candidate_id
+            for candidate_id in (self._first_expired(exclude), self._first_untagged(exclude))
+            if candidate_id is not None
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate_id: self._waiting[candidate_id][0])
+
+class StateStore:
+    """Interface to the waiting queue and the current pairs; every method is one atomic transition."""
+
+    async def load(self):
+        """Prepare the store once the database is ready."""
+
+    async def restore(self, max_age):
+        """Rebuild the live state after a restart.
+
+        Sessions that started more than max_age seconds ago are ended instead
+        of restored. Returns their (user1_id, user2_id) pairs so both users can
+        be told.
+        """
+        return []
+
+    async def save_snapshot(self):
+        """Persist the live state that is not already kept in the database."""
+
+    async def match_or_enqueue(self, user_id, tags):
+        """Pair the user with the best waiting partner, or queue them.
+
+        Returns ('paired', partner_id, pair_id) if the user already has a
+        partner, ('waiting', None, None) if they are already queued,
+        ('matched', partner_id, pair_id) if a new chat session was started, or
+        ('queued', None, None).
+        """
+        raise NotImplementedError
+
+    async def match_fallback(self):
+        """Start a chat between two users past the fallback threshold.
+
+        Returns (user_id, partner_id, pair_id), or None if no two users qualify.
+        """
+        raise NotImplementedError
+
+    async def cancel(self, user_id):
+        """Take a user out of the waiting queue. Return False if they were not waiting."""
+        raise NotImplementedError
+
+    async def unpair(self, user_id, pair_id=None):
+        """End the user's chat session and return the partner's ID, or None if they had none.
+
+        With pair_id, the session is only ended if it is still that one, so a
+        stale caller cannot end a chat the user has started since.
+        """
+        raise NotImplementedError
+
+    async def partner_of(self, user_id):
+        """Return (partner_id, pair_id) for the user's current session, or None."""
+        raise NotImplementedError
+
+    async def touch(self, user_id, pair_id):
+        """Record that a message was just relayed in the session."""
+        raise NotImplementedError
+
+    async def expire_idle(self, user_id, pair_id, idle_seconds):
+        """End the session if nothing was relayed in it for idle_seconds.
+
+        Returns ('ended', partner_id) if it was ended, ('active', seconds)
+        with the time left before it would be idle, or ('gone', None) if the
+        session is no longer the user's current one.
+        """
+        raise NotImplementedError
+
+    async def expire_waiter(self, user_id, max_wait):
+        """Take the user out of the queue if they have waited max_wait seconds.
+
+        Returns ('expired', None) if they were taken out, ('waiting', seconds)
+        with the time left, or ('gone', None) if they are no longer waiting.
+        """
+        raise NotImplementedError
+
+    async def live_sessions(self):
+        """Return (sessions, waiting): a (user_id, pair_id) for every live pair and the waiting user IDs."""
+        raise NotImplementedError
+
+    async def counts(self):
+        """Return the number of waiting users and of active pairs."""
+        raise NotImplementedError
+
+class MemoryStateStore(StateStore):
+    """Keep the matchmaking state in memory, for a single bot process.
+
+    Transitions update the state before their first await, which makes them atomic on the event loop.
+    """
+
+    def __init__(self, snapshot_path=None):
+        self.waiting_users = MatchQueue()
+        # user_id -> (partner_id, pair_id) of the current session, so a user
+        # can never have a partner without a session or the other way around
+        self.sessions = {}
+        self.last_active = {}  # pair_id -> time.monotonic() of the last message relayed in the session
+        self.snapshot_path = snapshot_path
+        self._pair_ids = None
+
+    async def load(self):
+        # Session IDs are handed out here so a pair is complete before the row is written
+        row = await db.fetchone("SELECT MAX(id) FROM chat_pairs")
+        self._pair_ids = itertools.count((row[0] or 0) + 1)
+
+    async def restore(self, max_age):
+        # Newest sessions first, so a user left in two open sessions by an old crash keeps the latest one
+        rows = await db.fetchall(
+            "SELECT id, user1_id, user2_id, (julianday('now') - julianday(connected_at)) * 86400 "
+            "FROM chat_pairs WHERE disconnected_at IS NULL ORDER BY id DESC"
+        )
+        closed = []
+        ended = []
+        for pair_id, user1_id, user2_id, age in rows:
+            if user1_id in self.sessions or user2_id in self.sessions:
+                closed.append((pair_id,))
+            elif max_age is not None and age > max_age:
+                closed.append((pair_id,))
+                ended.append((user1_id, user2_id))
+            else:
+                self.sessions[user1_id] = (user2_id, pair_id)
+                self.sessions[user2_id] = (user1_id, pair_id)
+                # Activity before the restart is not known, so restored chats start a new idle period
+                self.last_active[pair_id] = time.monotonic()
+        if closed:
+            await db.executemany("UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ?", closed)
+
+        snapshot = await asyncio.to_thread(read_snapshot, self.snapshot_path) if self.snapshot_path else None
+        waiting = snapshot['waiting'] if snapshot else []
+        # Waiting times are saved as wall-clock times and converted back to the monotonic clock
+        offset = time.monotonic() - time.time()
+        for user_id, since, tags in waiting:
+            if user_id not in self.sessions:
+                self.waiting_users.add(user_id, frozenset(tags), since + offset)
+
+        logger.info(
+            "Restored %d chats and %d waiting users (%s), ended %d stale chats",
+            len(self.sessions) // 2, len(self.waiting_users),
+            'from snapshot' if snapshot else 'no snapshot', len(ended)
+        )
+        return ended
+
+    async def save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        offset = time.time() - time.monotonic()
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'taken_at': time.time(),
+            'waiting': [[user_id, since + offset, sorted(tags)] for user_id, since, tags in self.waiting_users.entries()],
+            # Pairs are for inspection only; restore reads them from chat_pairs, which is always current
+            'pairs': [[user_id, partner_id, pair_id] for user_id, (partner_id, pair_id) in self.sessions.items() if user_id < partner_id],
+        }
+        data = json.dumps(snapshot, separators=(',', ':')).encode()
+        await asyncio.to_thread(write_file_atomically, self.snapshot_path, data)
+
+    def _pair(self, user_id, partner_id):
+        pair_id = next(self._pair_ids)
+        self.sessions[user_id] = (partner_id, pair_id)
+        self.sessions[partner_id] = (user_id, pair_id)
+        self.last_active[pair_id] = time.monotonic()
+        return pair_id
+
+    async def match_or_enqueue(self, user_id, tags):
+        session = self.sessions.get(user_id)
+        if session is not None:
+            return ('paired', *session)
+        if user_id in self.waiting_users:
+            return 'waiting', None, None
+        partner_id = self.waiting_users.pop_partner(user_id, tags)
+        if partner_id is None:
+            self.waiting_users.add(user_id, tags)
+            return 'queued', None, None
+        pair_id = self._pair(user_id, partner_id)
+
+        # Save chat pair to the database
+        await self._record_start(pair_id, user_id, partner_id)
+        return 'matched', partner_id, pair_id
+
+    async def match_fallback(self):
+        pair = self.waiting_users.pop_fallback_pair()
+        if pair is None:
+            return None
+        user_id, partner_id = pair
+        pair_id = self._pair(user_id, partner_id)
+
+        await self._record_start(pair_id, user_id, partner_id)
+        return user_id, partner_id, pair_id
+
+    async def cancel(self, user_id):
+        return self.waiting_users.remove(user_id)
+
+    async def unpair(self, user_id, pair_id=None):
+        session = self.sessions.get(user_id)
+        if session is None or (pair_id is not None and session[1] != pair_id):
+            return None
+        partner_id, pair_id = session
+        del self.sessions[user_id]
+        if self.sessions.get(partner_id) == (user_id, pair_id):
+            del self.sessions[partner_id]
+        self.last_active.pop(pair_id, None)
+
+        # Update disconnect time in the database
+        await self._record_end(pair_id, user_id, partner_id)
+        return partner_id
+
+    async def partner_of(self, user_id):
+        return self.sessions.get(user_id)
+
+    async def touch(self, user_id, pair_id):
+        # A session that has already ended is not brought back
+        if pair_id in self.last_active:
+            self.last_active[pair_id] = time.monotonic()
+
+    async def expire_idle(self, user_id, pair_id, idle_seconds):
+        # unpair ends the session before its first await, so no message can slip in after the idle check
+        session = self.sessions.get(user_id)
+        if session is None or session[1] != pair_id:
+            return 'gone', None
+        idle = time.monotonic() - self.last_active[pair_id]
+        if idle < idle_seconds:
+            return 'active', idle_seconds - idle
+        return 'ended', await self.unpair(user_id, pair_id)
+
+    async def expire_waiter(self, user_id, max_wait):
+        since = self.waiting_users.waiting_since(user_id)
+        if since is None:
+            return 'gone', None
+        waited = time.monotonic() - since
+        if waited < max_wait:
+            return 'waiting', max_wait - waited
+        self.waiting_users.remove(user_id)
+        return 'expired', None
+
+    async def live_sessions(self):
+        sessions = [(user_id, pair_id) for user_id, (partner_id, pair_id) in self.sessions.items() if user_id < partner_id]
+        return sessions, [user_id for user_id, _, _ in self.waiting_users.entries()]
+
+    @staticmethod
+    async def _record_start(pair_id, user_id, partner_id):
+        # Does nothing if the end of the session was written first
+        await db.execute(
+            "INSERT INTO chat_pairs (id, user1_id, user2_id) VALUES (?, ?, ?) ON CONFLICT (id) DO NOTHING",
+            (pair_id, user_id, partner_id)
+        )
+
+    @staticmethod
+    async def _record_end(pair_id, user_id, partner_id):
+        # Creates the row already closed if the start of the session has not been written yet
+        await db.execute(
+            '''
+            INSERT INTO chat_pairs (id, user1_id, user2_id, disconnected_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (id) DO UPDATE SET disconnected_at = excluded.disconnected_at
+            ''',
+            (pair_id, user_id, partner_id)
+        )
+
+    async def counts(self):
+        return len(self.waiting_users), len(self.sessions) // 2
 
-# List to store waiting users
-waiting_users = []
+class SQLiteStateStore(StateStore):
+    """Keep the matchmaking state in the database, shared by every bot process on the host.
 
-async def is_sudo_user(user_id):
-    with sudo_conn:
-        cursor = sudo_conn.execute(
-            "SELECT user_id FROM sudo_users WHERE user_id = ?", (user_id,)
+    Each transition is one BEGIN IMMEDIATE transaction, and times use the wall clock so processes agree on them.
+    """
+
+    def __init__(self, database, fallback_after=MATCH_FALLBACK_SECONDS):
+        self.database = database
+        self.fallback_after = fallback_after
+        # pair_id -> time.monotonic() of this process's last activity write, oldest first
+        self._activity_written = OrderedDict()
+
+    def _add(self, conn, user_id, tags):
+        since = time.time()
+        conn.execute(
+            "INSERT INTO live_waiting (user_id, since, tagged) VALUES (?, ?, ?)",
+            (user_id, since, 1 if tags else 0)
+        )
+        conn.executemany(
+            "INSERT INTO live_waiting_tags (tag, user_id, since) VALUES (?, ?, ?)",
+            [(tag, user_id, since) for tag in tags]
         )
-        return cursor.fetchone() is not None
+
+    def _remove(self, conn, user_id):
+        conn.execute("DELETE FROM live_waiting_tags WHERE user_id = ?", (user_id,))
+        return conn.execute("DELETE FROM live_waiting WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    def _best_overlap(self, conn, user_id, tags):
+        overlap = {}
+        since = {}
+        for tag in tags:
+            rows = conn.execute(
+                "SELECT user_id, since FROM live_waiting_tags WHERE tag = ? AND user_id != ? ORDER BY since LIMIT ?",
+                (tag, user_id, MATCH_CANDIDATES_PER_TAG)
+            )
+            for candidate_id, candidate_since in rows:
+                overlap[candidate_id] = overlap.get(candidate_id, 0) + 1
+                since[candidate_id] = candidate_since
+        if not overlap:
+            return None
+        return max(overlap, key=lambda candidate_id: (overlap[candidate_id], -since[candidate_id]))
+
+    def _first_expired(self, conn, exclude_id):
+        if self.fallback_after is None:
+            return None
+        return conn.execute(
+            "SELECT user_id, since FROM live_waiting WHERE since <= ? AND user_id IS NOT ? ORDER BY since LIMIT 1",
+            (time.time() - self.fallback_after, exclude_id)
+        ).fetchone()
+
+    def _first_fallback(self, conn, exclude_id):
+        # The longest-waiting user who accepts anyone
+        candidates = [
+            row for row in (
+                self._first_expired(conn, exclude_id),
+                conn.execute(
+                    "SELECT user_id, since FROM live_waiting WHERE tagged = 0 AND user_id IS NOT ? ORDER BY since LIMIT 1",
+                    (exclude_id,)
+                ).fetchone(),
+            )
+            if row is not None
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda row: row[1])[0]
+
+    def _start_chat(self, conn, user_id, partner_id):
+        pair_id = conn.execute(
+            "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)",
+            (user_id, partner_id)
+        ).lastrowid
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO live_pairs (user_id, partner_id, pair_id, last_active) VALUES (?, ?, ?, ?)",
+            [(user_id, partner_id, pair_id, now), (partner_id, user_id, pair_id, now)]
+        )
+        return pair_id
+
+    def _match_or_enqueue(self, conn, user_id, tags):
+        row = conn.execute("SELECT partner_id, pair_id FROM live_pairs WHERE user_id = ?", (user_id,)).fetchone()
+        if row is not None:
+            return ('paired', *row)
+        if conn.execute("SELECT 1 FROM live_waiting WHERE user_id = ?", (user_id,)).fetchone() is not None:
+            return 'waiting', None, None
+        if tags:
+            partner_id = self._best_overlap(conn, user_id, tags)
+        else:
+            partner_id = self._first_fallback(conn, user_id)
+        if partner_id is None:
+            self._add(conn, user_id, tags)
+            return 'queued', None, None
+        self._remove(conn, partner_id)
+        return 'matched', partner_id, self._start_chat(conn, user_id, partner_id)
+
+    def _match_fallback(self, conn):
+        first = self._first_expired(conn, None)
+        if first is None:
+            return None
+        user_id = first[0]
+        partner_id = self._first_fallback(conn, user_id)
+        if partner_id is None:
+            return None
+        self._remove(conn, user_id)
+        self._remove(conn, partner_id)
+        return user_id, partner_id, self._start_chat(conn, user_id, partner_id)
+
+    def _unpair(self, conn, user_id, expected_pair_id):
+        row = conn.execute("SELECT partner_id, pair_id FROM live_pairs WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or (expected_pair_id is not None and row[1] != expected_pair_id):
+            return None
+        partner_id, pair_id = row
+        conn.execute("DELETE FROM live_pairs WHERE pair_id = ?", (pair_id,))
+        conn.execute("UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE id = ?", (pair_id,))
+        return partner_id
+
+    def _expire_idle(self, conn, user_id, pair_id, idle_seconds):
+        row = conn.execute("SELECT pair_id, last_active FROM live_pairs WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or row[0] != pair_id:
+            return 'gone', None
+        idle = time.time() - row[1]
+        if idle < idle_seconds:
+            return 'active', idle_seconds - idle
+        return 'ended', self._unpair(conn, user_id, pair_id)
+
+    def _expire_waiter(self, conn, user_id, max_wait):
+        row = conn.execute("SELECT since FROM live_waiting WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return 'gone', None
+        waited = time.time() - row[0]
+        if waited < max_wait:
+            return 'waiting', max_wait - waited
+        self._remove(conn, user_id)
+        return 'expired', None
+
+    async def match_or_enqueue(self, user_id, tags):
+        return await self.database.immediate_transaction(self._match_or_enqueue, user_id, tags)
+
+    async def match_fallback(self):
+        return await self.database.immediate_transaction(self._match_fallback)
+
+    async def cancel(self, user_id):
+        return await self.database.immediate_transaction(self._remove, user_id)
+
+    async def unpair(self, user_id, pair_id=None):
+        return await self.database.immediate_transaction(self._unpair, user_id, pair_id)
+
+    async def partner_of(self, user_id):
+        return await self.database.fetchone("SELECT partner_id, pair_id FROM live_pairs WHERE user_id = ?", (user_id,))
+
+    async def touch(self, user_id, pair_id):
+        # Written at most once per ACTIVITY_WRITE_INTERVAL per session, so a busy
+        # chat costs one write a minute instead of one per message
+        now = time.monotonic()
+        last_write = self._activity_written.get(pair_id)
+        if last_write is not None and now - last_write < ACTIVITY_WRITE_INTERVAL:
+            return
+        while self._activity_written and now - next(iter(self._activity_written.values())) >= ACTIVITY_WRITE_INTERVAL:
+            self._activity_written.popitem(last=False)
+        self._activity_written[pair_id] = now
+        await self.database.execute("UPDATE live_pairs SET last_active = ? WHERE pair_id = ?", (time.time(), pair_id))
+
+    async def expire_idle(self, user_id, pair_id, idle_seconds):
+        return await self.database.immediate_transaction(self._expire_idle, user_id, pair_id, idle_seconds)
+
+    async def expire_waiter(self, user_id, max_wait):
+        return await self.database.immediate_transaction(self._expire_waiter, user_id, max_wait)
+
+    async def live_sessions(self):
+        sessions = await self.database.fetchall("SELECT user_id, pair_id FROM live_pairs WHERE user_id < partner_id")
+        waiting = await self.database.fetchall("SELECT user_id FROM live_waiting")
+        return [tuple(row) for row in sessions], [user_id for user_id, in waiting]
+
+    async def counts(self):
+        return await self.database.fetchone(
+            "SELECT (SELECT COUNT(*) FROM live_waiting), (SELECT COUNT(*) FROM live_pairs) / 2"
+        )
+
+# Where the matchmaking state lives: 'memory' keeps it in this process, 'sqlite'
+# shares it through telegram_bot.db so several worker processes on this host can
+# serve one matchmaking pool (run them in webhook mode, since Telegram only allows
+# one polling consumer per bot, and set SEND_WORKER_PROCESSES to their number)
+STATE_BACKEND = 'memory'
+CACHE_REFRESH_INTERVAL = 30  # Seconds between ban/sudo cache reloads when state is shared between processes
+
+# Warm restart settings for the 'memory' backend
+SNAPSHOT_PATH = 'state_snapshot.json'  # Where the waiting queue is saved between restarts
+SNAPSHOT_INTERVAL = 30  # Seconds between snapshots; one is also taken on shutdown
+SNAPSHOT_VERSION = 1
+SESSION_RESTORE_MAX_AGE = 24 * 3600  # Chats older than this are ended instead of restored after a restart (None restores all)
+
+def write_file_atomically(path, data):
+    """Replace the file at path with data so readers never see a partial file, even after a crash."""
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path.parent)
+
+def fsync_directory(path):
+    """Make a rename or link into the directory at path durable."""
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def read_snapshot(path):
+    """Return the snapshot saved at path, or None if there is no usable one."""
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logger.exception("Ignoring unreadable state snapshot %s", path)
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.warning("Ignoring state snapshot %s with unknown version %r", path, snapshot.get('version'))
+        return None
+    return snapshot
+
+def create_state_store(backend):
+    """Create the state store for the configured backend."""
+    if backend == 'memory':
+        return MemoryStateStore(SNAPSHOT_PATH)
+    if backend == 'sqlite':
+        return SQLiteStateStore(db)
+    raise ValueError(f"Unknown state backend: {backend}")
+
+# Live matchmaking state
+state = create_state_store(STATE_BACKEND)
+
+# Idle timeout settings
+SESSION_IDLE_SECONDS = 30 * 60  # A chat in which nothing was sent for this long is ended (None disables)
+WAITING_EXPIRY_SECONDS = 30 * 60  # A user who waited this long without finding a partner stops waiting (None disables)
+IDLE_CHECK_INTERVAL = 5  # Seconds between passes over the timer wheel
+IDLE_WHEEL_SLOTS = 512  # Slots in the timer wheel; slots * IDLE_CHECK_INTERVAL should exceed both timeouts
+ACTIVITY_WRITE_INTERVAL = 60  # Least seconds between last-activity writes for one chat with the 'sqlite' backend
+
+class TimerWheel:
+    """Hashed timer wheel that hands back keys once their deadline has passed.
+
+    A key is filed in the slot of its due tick modulo the number of slots, so
+    scheduling is O(1) and each advance only visits the slots of the ticks
+    that have passed since the last one. A key due more than one turn of the
+    wheel ahead stays in its slot until the turn it is due in. Scheduling a
+    key that is already pending keeps its earlier deadline.
+    """
+
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._due = {}  # key -> tick number the key is due at
+        self._current = self._tick_at(time.monotonic())
+
+    def __len__(self):
+        return len(self._due)
+
+    def _tick_at(self, timestamp):
+        return math.floor(timestamp / self.tick)
+
+    def schedule(self, key, delay):
+        """Hand key back from advance once delay seconds have passed."""
+        if key in self._due:
+            return
+        due = max(self._current + 1, math.ceil((time.monotonic() + delay) / self.tick))
+        self._due[key] = due
+        self._slots[due % len(self._slots)].append(key)
+
+    def advance(self):
+        """Return the keys that have become due since the last call."""
+        target = self._tick_at(time.monotonic())
+        expired = []
+        if target - self._current >= len(self._slots):
+            # Fell behind by more than a turn, so every slot is due once
+            for index in range(len(self._slots)):
+                self._expire_slot(index, target, expired)
+        else:
+            for tick in range(self._current + 1, target + 1):
+                self._expire_slot(tick % len(self._slots), tick, expired)
+        self._current = max(self._current, target)
+        return expired
+
+    def _expire_slot(self, index, now, expired):
+        later = []
+        for key in self._slots[index]:
+            if self._due[key] <= now:
+                del self._due[key]
+                expired.append(key)
+            else:
+                later.append(key)
+        self._slots[index] = later
+
+# Chats and waiting users to check for the idle timeouts
+idle_timers = TimerWheel(IDLE_CHECK_INTERVAL, IDLE_WHEEL_SLOTS)
+
+# Dictionary of banned user IDs to (reason, banned_until), mirrored from the banned_users table
+ban_cache = {}
+
+async def load_ban_cache():
+    """Load every ban from the database into the ban cache."""
+    rows = await db.fetchall("SELECT user_id, reason, banned_until FROM banned_users")
+    ban_cache.clear()
+    for user_id, reason, banned_until in rows:
+        ban_cache[user_id] = (reason, banned_until)
+    logger.info("Loaded %d bans", len(ban_cache))
+
+# Set of sudo user IDs, mirrored from the sudo_users table
+sudo_cache = set()
+
+async def load_sudo_cache():
+    """Load every sudo user ID from the database into the sudo cache."""
+    rows = await db.fetchall("SELECT user_id FROM sudo_users")
+    sudo_cache.clear()
+    sudo_cache.update(user_id for user_id, in rows)
+    logger.info("Loaded %d sudo users", len(sudo_cache))
+
+async def refresh_caches(context: CallbackContext) -> None:
+    """Reload the ban and sudo caches to pick up changes made by other worker processes."""
+    known_bans = set(ban_cache)
+    await load_ban_cache()
+    await load_sudo_cache()
+    # The banning process has normally done this already; doing it again is harmless
+    for user_id in ban_cache.keys() - known_bans:
+        await remove_banned_user(context.bot, user_id)
+
+# Commands a banned user can still use
+BANNED_USER_COMMANDS = ('start', 'help', 'rules', 'appeal')
+
+async def apply_ban(bot, user_id, reason, banned_until=None):
+    """Enforce a ban that has just been written to banned_users."""
+    ban_cache[user_id] = (reason, banned_until)
+    await remove_banned_user(bot, user_id)
+
+async def remove_banned_user(bot, user_id):
+    """Take a banned user out of the waiting queue and end their chat, telling the partner."""
+    await state.cancel(user_id)
+    partner_id = await state.unpair(user_id)
+    if partner_id is not None:
+        with contextlib.suppress(TelegramError):
+            await bot.send_message(partner_id, 'Your chat partner is no longer available. Type /connect to find a new one.')
+
+async def reject_banned_users(update: Update, context: CallbackContext) -> None:
+    """Stop every update from a banned user before the other handlers see it."""
+    user = update.effective_user
+    if user is None or user.id not in ban_cache:
+        return
+    message = update.message
+    if message is not None and message.chat.type == message.chat.PRIVATE:
+        command = message.text.split()[0].lstrip('/').split('@')[0] if message.text and message.text.startswith('/') else None
+        if command in BANNED_USER_COMMANDS:
+            return
+        reason, banned_until = ban_cache[user.id]
+        until = f' until {banned_until}' if banned_until else ''
+        await message.reply_text(f'You are banned from using this bot{until}. Reason: {reason}')
+    raise ApplicationHandlerStop
+
+# Message log writer settings
+MESSAGE_QUEUE_SIZE = 10000  # Relays wait for room once this many records are pending
+MESSAGE_BATCH_SIZE = 500  # Maximum number of records written in one transaction
+MESSAGE_FLUSH_INTERVAL = 1.0  # Maximum number of seconds a record waits before it is written
+
+# Queue of message records waiting to be written to the database
+message_queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+message_writer_task = None
+
+async def write_messages(batch):
+    """Write a batch of message records in a single transaction."""
+    try:
+        await db.executemany(
+            "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
+            batch
+        )
+    except sqlite3.Error:
+        logger.exception("Failed to write %d message records", len(batch))
+
+async def log_message(pair_id, sender_id, message, media_type, media_id):
+    """Queue a message record for the background writer."""
+    await message_queue.put((pair_id, sender_id, message, media_type, media_id))
+
+async def message_writer() -> None:
+    """Drain the message queue and write the records in batches."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await message_queue.get()]
+        try:
+            deadline = loop.time() + MESSAGE_FLUSH_INTERVAL
+            while len(batch) < MESSAGE_BATCH_SIZE:
+                if not message_queue.empty():
+                    batch.append(message_queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(message_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Also runs on cancellation so a half-collected batch is not lost
+            await write_messages(batch)
+            for _ in batch:
+                message_queue.task_done()
+
+async def flush_message_queue():
+    """Write every record still waiting in the message queue."""
+    batch = []
+    while not message_queue.empty():
+        batch.append(message_queue.get_nowait())
+        message_queue.task_done()
+        if len(batch) >= MESSAGE_BATCH_SIZE:
+            await write_messages(batch)
+            batch = []
+    if batch:
+        await write_messages(batch)
+
+# Message retention settings. With several worker processes, enable the job in one of them only.
+MESSAGE_RETENTION_DAYS = 30  # Messages of chats that ended this many days ago are archived and deleted (None keeps them forever)
+RETENTION_INTERVAL = 3600  # Seconds between retention passes
+RETENTION_SESSION_BATCH = 100  # Ended chats archived together into one file
+RETENTION_CHUNK_SIZE = 500  # Messages read or deleted per statement, so the writer is never held for long
+ARCHIVE_DIR = 'archive'  # Archives go to ARCHIVE_DIR/<date the chats ended>/ (None deletes without archiving)
+
+def archive_message(row):
+    """Turn a messages row into the dict stored in an archive."""
+    message_id, sender_id, message, media_type, media_id, sent_at = row
+    return {'id': message_id, 'sender_id': sender_id, 'message': message, 'media_type': media_type, 'media_id': media_id, 'sent_at': sent_at}
+
+def write_archive(conn, path, sessions):
+    """Stream sessions and their messages to a new gzipped JSON lines archive and return its path."""
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode='wb') as archive:
+            for pair_id, user1_id, user2_id, connected_at, disconnected_at in sessions:
+                header = json.dumps({
+                    'pair_id': pair_id,
+                    'user1_id': user1_id,
+                    'user2_id': user2_id,
+                    'connected_at': connected_at,
+                    'disconnected_at': disconnected_at,
+                }, default=str)
+                # The header object is left open so the messages can follow it as they are read
+                archive.write(header[:-1].encode('utf-8') + b', "messages": [')
+                separator = b''
+                last_id = 0
+                while True:
+                    rows = conn.execute(
+                        "SELECT id, sender_id, message, media_type, media_id, sent_at FROM messages WHERE pair_id = ? AND id > ? ORDER BY id LIMIT ?",
+                        (pair_id, last_id, RETENTION_CHUNK_SIZE)
+                    ).fetchall()
+                    for row in rows:
+                        archive.write(separator + json.dumps(archive_message(row), default=str).encode('utf-8'))
+                        separator = b', '
+                    if len(rows) < RETENTION_CHUNK_SIZE:
+                        break
+                    last_id = rows[-1][0]
+                archive.write(b']}\n')
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+
+    target = path
+    for number in itertools.count(1):
+        try:
+            # Unlike a rename, a link fails instead of replacing an existing file
+            os.link(tmp_path, target)
+            break
+        except FileExistsError:
+            target = path.with_name(path.name.replace('.jsonl.gz', f'.{number}.jsonl.gz'))
+    os.unlink(tmp_path)
+    fsync_directory(path.parent)
+    return target
+
+async def archive_sessions(sessions):
+    """Archive the messages of ended sessions, one new file per day the sessions ended."""
+    by_day = collections.defaultdict(list)
+    for session in sessions:
+        by_day[str(session[4])[:10]].append(session)
+    for day, day_sessions in by_day.items():
+        name = f"chats-{day_sessions[0][0]}-{day_sessions[-1][0]}.jsonl.gz"
+        await db.read(write_archive, pathlib.Path(ARCHIVE_DIR, day, name), day_sessions)
+
+async def purge_session(pair_id):
+    """Delete an archived session's messages in small chunks and mark the session purged."""
+    def delete_chunk(conn):
+        return conn.execute(
+            "DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE pair_id = ? LIMIT ?)",
+            (pair_id, RETENTION_CHUNK_SIZE)
+        ).rowcount
+
+    deleted = 0
+    while (count := await db.transaction(delete_chunk)):
+        deleted += count
+    await db.execute("UPDATE chat_pairs SET purged_at = CURRENT_TIMESTAMP WHERE id = ?", (pair_id,))
+    return deleted
+
+async def enforce_retention(context: CallbackContext) -> None:
+    """Archive and delete the messages of unreported chats that ended before the retention period."""
+    sessions_done = messages_deleted = 0
+    # Finish deleting chats that an interrupted pass had already archived
+    for pair_id, in await db.fetchall("SELECT id FROM chat_pairs WHERE archived_at IS NOT NULL AND purged_at IS NULL"):
+        messages_deleted += await purge_session(pair_id)
+
+    while True:
+        sessions = await db.fetchall(
+            '''
+            SELECT id, user1_id, user2_id, connected_at, disconnected_at FROM chat_pairs
+            WHERE archived_at IS NULL AND disconnected_at IS NOT NULL AND disconnected_at < datetime('now', ?)
+              AND NOT EXISTS (SELECT 1 FROM reports WHERE reports.pair_id = chat_pairs.id AND status = 'pending')
+            ORDER BY disconnected_at, id LIMIT ?
+            ''',
+            (f'-{MESSAGE_RETENTION_DAYS} days', RETENTION_SESSION_BATCH)
+        )
+        if not sessions:
+            break
+        if ARCHIVE_DIR is not None:
+            await archive_sessions(sessions)
+        await db.executemany("UPDATE chat_pairs SET archived_at = CURRENT_TIMESTAMP WHERE id = ?", [(session[0],) for session in sessions])
+        for session in sessions:
+            messages_deleted += await purge_session(session[0])
+        sessions_done += len(sessions)
+
+    if sessions_done:
+        logger.info("Retention: archived %d chats and deleted %d messages", sessions_done, messages_deleted)
+
+async def start_message_writer(application: Application) -> None:
+    """Start the background message writer."""
+    global message_writer_task
+    message_writer_task = asyncio.create_task(message_writer())
+
+async def post_init(application: Application) -> None:
+    """Load the in-memory caches and start the background tasks."""
+    await load_ban_cache()
+    await load_sudo_cache()
+    await state.load()
+    ended = await state.restore(SESSION_RESTORE_MAX_AGE)
+    if ended:
+        # Sent from a job once the application is running, so a long list does not hold up startup
+        application.job_queue.run_once(notify_restart_ended_chats, 0, data=ended)
+    await watch_live_sessions()
+    await start_message_writer(application)
+    await start_metrics_server()
+
+async def notify_restart_ended_chats(context: CallbackContext) -> None:
+    """Tell users whose chat was too old to restore after a restart that it has ended."""
+    for pair in context.job.data:
+        for chat_id in pair:
+            with contextlib.suppress(TelegramError):
+                await context.bot.send_message(chat_id, 'Your chat has ended while the bot was restarting. Type /connect to find a new chat partner.')
+
+async def save_state_snapshot(context: CallbackContext) -> None:
+    """Save the live state so a restart can pick up where it left off."""
+    try:
+        await state.save_snapshot()
+    except OSError:
+        logger.exception("Failed to save state snapshot")
+
+async def post_stop(application: Application) -> None:
+    """Relay albums still being collected, stop the background tasks and save a final snapshot."""
+    await stop_metrics_server()
+    await albums.flush_all()
+    await stop_message_writer(application)
+    try:
+        await state.save_snapshot()
+    except OSError:
+        logger.exception("Failed to save state snapshot")
+
+async def stop_message_writer(application: Application) -> None:
+    """Stop the background message writer and flush pending records."""
+    if message_writer_task is not None:
+        message_writer_task.cancel()
+        try:
+            await message_writer_task
+        except asyncio.CancelledError:
+            pass
+    await flush_message_queue()
+
+async def close_database(application: Application) -> None:
+    """Close the database connections."""
+    db.close()
+
+def is_sudo_user(user_id):
+    return user_id in sudo_cache
+
+def is_admin(user_id):
+    return user_id == BOT_OWNER_ID or is_sudo_user(user_id)
+
+def owner_only(handler):
+    """Only let the bot owner run the decorated command handler."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext) -> None:
+        if update.message.chat_id != BOT_OWNER_ID:
+            await update.message.reply_text('You do not have permission to use this command.')
+            return
+        await handler(update, context)
+    return wrapper
+
+def admin_only(handler):
+    """Only let the bot owner and sudo users run the decorated command handler."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext) -> None:
+        if not is_admin(update.message.chat_id):
+            await update.message.reply_text('You do not have permission to use this command.')
+            return
+        await handler(update, context)
+    return wrapper
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Send a description of the bot when the command /start is issued."""
@@ -106,13 +1952,18 @@ async def help_command(update: Update, context: CallbackContext) -> None:
     """Send a list of available commands when the command /help is issued."""
     await update.message.reply_text(
         "/start - Show the bot description\n"
-        "/connect - Find a chat partner\n"
+        "/connect [tags] - Find a chat partner, optionally by interests or language (e.g. /connect music en)\n"
+        "/cancel - Stop waiting for a chat partner\n"
         "/disconnect - End the chat\n"
         "/report <reason> - Report a user\n"
         "/appeal - Appeal a ban\n"
         "/rules - Show the rules\n"
         "/ban <user_id> <reason> - Ban a user (admin only)\n"
-        "/unban <user_id> - Unban a user (admin only)"
+        "/unban <user_id> - Unban a user (admin only)\n"
+        "/sendqueue - Show the outbound send queue (admin only)\n"
+        "/deadletters - List undelivered messages (admin only)\n"
+        "/replay <id> - Send an undelivered message again (admin only)\n"
+        "/profile [seconds] - Record a sampling profile of the bot (admin only)"
     )
 
 async def rules(update: Update, context: CallbackContext) -> None:
@@ -126,13 +1977,9 @@ async def rules(update: Update, context: CallbackContext) -> None:
         "Violating these rules may result in a ban."
     )
 
+@owner_only
 async def add_sudo(update: Update, context: CallbackContext) -> None:
     """Add a sudo user."""
-    user_id = update.message.chat_id
-    if user_id != BOT_OWNER_ID:
-        await update.message.reply_text('You do not have permission to use this command.')
-        return
-
     try:
         target_id = int(update.message.text.split()[1])
         username = update.message.text.split()[2]
@@ -140,40 +1987,32 @@ async def add_sudo(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text('Usage: /addsudo <user_id> <username>')
         return
 
-    with sudo_conn:
-        sudo_conn.execute(
-            "INSERT INTO sudo_users (user_id, username) VALUES (?, ?)",
-            (target_id, username)
-        )
+    await db.execute(
+        "INSERT INTO sudo_users (user_id, username) VALUES (?, ?)",
+        (target_id, username)
+    )
+    sudo_cache.add(target_id)
     await update.message.reply_text(f'User {username} has been added as a sudo user.')
 
+@owner_only
 async def del_sudo(update: Update, context: CallbackContext) -> None:
     """Delete a sudo user."""
-    user_id = update.message.chat_id
-    if user_id != BOT_OWNER_ID:
-        await update.message.reply_text('You do not have permission to use this command.')
-        return
-
     try:
         target_id = int(update.message.text.split()[1])
     except (IndexError, ValueError):
         await update.message.reply_text('Usage: /delsudo <user_id>')
         return
 
-    with sudo_conn:
-        sudo_conn.execute(
-            "DELETE FROM sudo_users WHERE user_id = ?",
-            (target_id,)
-        )
+    await db.execute(
+        "DELETE FROM sudo_users WHERE user_id = ?",
+        (target_id,)
+    )
+    sudo_cache.discard(target_id)
     await update.message.reply_text(f'User {target_id} has been removed as a sudo user.')
 
+@admin_only
 async def ban_user(update: Update, context: CallbackContext) -> None:
     """Ban a user."""
-    user_id = update.message.chat_id
-    if not (await is_sudo_user(user_id)) and user_id != BOT_OWNER_ID:
-        await update.message.reply_text('You do not have permission to use this command.')
-        return
-
     try:
         target_id = int(update.message.text.split()[1])
         reason = ' '.join(update.message.text.split()[2:])
@@ -181,209 +2020,659 @@ async def ban_user(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text('Usage: /ban <user_id> <reason>')
         return
 
-    if target_id == BOT_OWNER_ID or await is_sudo_user(target_id):
+    if is_admin(target_id):
         await update.message.reply_text('You cannot ban this user because they are an admin.')
         return
 
-    with conn:
-        conn.execute(
-            "INSERT INTO banned_users (user_id, reason, banned_until) VALUES (?, ?, ?)",
-            (target_id, reason, None)
-        )
+    await db.execute(
+        "INSERT INTO banned_users (user_id, reason, banned_until) VALUES (?, ?, ?)",
+        (target_id, reason, None)
+    )
+    await apply_ban(context.bot, target_id, reason)
     await update.message.reply_text(f'User {target_id} has been banned for: {reason}')
 
+@admin_only
 async def unban_user(update: Update, context: CallbackContext) -> None:
     """Unban a user."""
-    user_id = update.message.chat_id
-    if not (await is_sudo_user(user_id)) and user_id != BOT_OWNER_ID:
-        await update.message.reply_text('You do not have permission to use this command.')
-        return
-
     try:
         target_id = int(update.message.text.split()[1])
     except (IndexError, ValueError):
         await update.message.reply_text('Usage: /unban <user_id>')
         return
 
-    with conn:
-        conn.execute(
-            "DELETE FROM banned_users WHERE user_id = ?",
-            (target_id,)
-        )
+    await db.execute(
+        "DELETE FROM banned_users WHERE user_id = ?",
+        (target_id,)
+    )
+    ban_cache.pop(target_id, None)
     await update.message.reply_text(f'User {target_id} has been unbanned.')
 
+@admin_only
+async def send_queue(update: Update, context: CallbackContext) -> None:
+    """Show the state of the outbound send queue."""
+    stats = outbox.stats()
+    queued = stats['queued']
+    await update.message.reply_text(
+        "Outbound queue:\n"
+        f"Relays waiting: {queued.get(PRIORITY_RELAY, 0)}\n"
+        f"Admin notifications waiting: {queued.get(PRIORITY_ADMIN, 0)}\n"
+        f"Bulk messages waiting: {queued.get(PRIORITY_BULK, 0)}\n"
+        f"In flight: {stats['in_flight']}\n"
+        f"Wait time: p50 {stats['wait_p50']:.2f}s, p95 {stats['wait_p95']:.2f}s, max {stats['wait_max']:.2f}s"
+    )
+
+@admin_only
+async def dead_letters(update: Update, context: CallbackContext) -> None:
+    """List the most recent sends that could not be delivered."""
+    rows = await db.fetchall(
+        "SELECT id, chat_id, endpoint, error, attempts, failed_at FROM dead_letters WHERE replayed_at IS NULL ORDER BY id DESC LIMIT ?",
+        (DEAD_LETTER_LIST_LIMIT,)
+    )
+    if not rows:
+        await update.message.reply_text('There are no undelivered messages.')
+        return
+
+    lines = [
+        f"#{dead_letter_id} {endpoint} to {chat_id} at {failed_at} after {attempts} attempts: {error}"
+        for dead_letter_id, chat_id, endpoint, error, attempts, failed_at in rows
+    ]
+    await update.message.reply_text("Undelivered messages:\n" + "\n".join(lines) + "\n\nUse /replay <id> to send one again.")
+
+@admin_only
+async def replay_dead_letter(update: Update, context: CallbackContext) -> None:
+    """Send an undelivered message again."""
+    try:
+        dead_letter_id = int(update.message.text.split()[1])
+    except (IndexError, ValueError):
+        await update.message.reply_text('Usage: /replay <id>')
+        return
+
+    row = await db.fetchone(
+        "SELECT endpoint, payload FROM dead_letters WHERE id = ? AND replayed_at IS NULL",
+        (dead_letter_id,)
+    )
+    if not row:
+        await update.message.reply_text(f'Undelivered message {dead_letter_id} not found.')
+        return
+
+    endpoint, payload = row
+    token = replaying_dead_letter.set(True)
+    try:
+        with warnings.catch_warnings():
+            # do_api_request warns that a dedicated method exists for the endpoint
+            warnings.simplefilter('ignore')
+            await context.bot.do_api_request(endpoint, api_kwargs=json.loads(payload))
+    except TelegramError as exc:
+        await update.message.reply_text(f'Replaying message {dead_letter_id} failed: {exc}')
+        return
+    finally:
+        replaying_dead_letter.reset(token)
+
+    await db.execute("UPDATE dead_letters SET replayed_at = CURRENT_TIMESTAMP WHERE id = ?", (dead_letter_id,))
+    await update.message.reply_text(f'Message {dead_letter_id} has been delivered.')
+
+class StackSampler:
+    """Sampling profiler that counts how often each thread stack is seen.
+
+    Runs on its own thread and reads every other thread's current frame at
+    a fixed interval, so it also sees time the event loop spends blocked.
+    Frames are identified by function, file and first line, so samples from
+    different lines of one function aggregate.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()  # 'thread;outer frame;...;leaf frame' -> samples
+        self.samples = 0
+
+    def run(self, duration):
+        sampler_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+        """Write the stacks in the collapsed format read by flame graph tools, most frequent first."""
+        lines = ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        write_file_atomically(path, lines.encode('utf-8'))
+
+    def hottest(self, thread_name, limit):
+        """Return the functions most often running on a thread, leaving out idle waits in the selector."""
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            if frames[0] == thread_name and 'selectors.py' not in frames[-1]:
+                leaves[frames[-1]] += count
+        return leaves.most_common(limit)
+
+# Sampling profile in progress, if any
+profile_task = None
+
+@admin_only
+async def profile_command(update: Update, context: CallbackContext) -> None:
+    """Sample every thread's stack for a while and write the hot stacks to a file."""
+    global profile_task
+    if profile_task is not None and not profile_task.done():
+        await update.message.reply_text('A profile is already being recorded.')
+        return
+
+    try:
+        duration = float(update.message.text.split()[1]) if len(update.message.text.split()) > 1 else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text('Usage: /profile [seconds]')
+        return
+    duration = min(max(duration, 1), PROFILE_MAX_SECONDS)
+
+    # The sampler runs in the background so updates keep being handled while it records
+    profile_task = context.application.create_task(
+        record_profile(context.bot, update.message.chat_id, duration, threading.current_thread().name)
+    )
+    await update.message.reply_text(f'Recording a profile for {duration:.0f} seconds.')
+
+async def record_profile(bot, chat_id, duration, loop_thread_name):
+    """Run the stack sampler, save its stacks and send a summary to chat_id."""
+    sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+    await asyncio.to_thread(sampler.run, duration)
+    path = pathlib.Path(PROFILE_DIR, f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt")
+    await asyncio.to_thread(sampler.write, path)
+    logger.info("Wrote profile with %d samples to %s", sampler.samples, path)
+
+    hottest = sampler.hottest(loop_thread_name, 5)
+    busy = sum(count for _, count in sampler.hottest(loop_thread_name, None))
+    lines = [f"{count / sampler.samples:6.1%}  {frame}" for frame, count in hottest]
+    with contextlib.suppress(TelegramError):
+        await bot.send_message(
+            chat_id,
+            f"Profile saved to {path} ({sampler.samples} samples).\n"
+            f"Event loop busy in {busy / max(sampler.samples, 1):.1%} of samples. Hottest functions:\n" + "\n".join(lines)
+        )
+
+async def error_handler(update: object, context: CallbackContext) -> None:
+    """Log errors that escape a handler."""
+    logger.error("Error while handling an update", exc_info=context.error)
+
 async def connect(update: Update, context: CallbackContext) -> None:
-    """Connect the user to a random chat partner."""
+    """Connect the user to a chat partner, preferring one who shares the given tags."""
     user_id = update.message.chat_id
 
-    cursor = conn.execute("SELECT reason, banned_until FROM banned_users WHERE user_id = ?", (user_id,))
-    banned_user = cursor.fetchone()
-    if banned_user:
-        reason, banned_until = banned_user
-        await update.message.reply_text(f'You are banned from using this bot until {banned_until}. Reason: {reason}')
-        return
+    tags = parse_tags(context.args)
+    status, partner_id, pair_id = await state.match_or_enqueue(user_id, tags)
 
-    if user_id in user_pairs:
+    if status == 'paired':
         await update.message.reply_text('You are already connected to a chat partner.')
+    elif status == 'waiting':
+        await update.message.reply_text('You are already waiting for a chat partner. Type /cancel to stop waiting.')
+    elif status == 'matched':
+        watch_session(user_id, pair_id)
+        await notify_connected(context.bot, user_id, partner_id, pair_id)
+    elif tags:
+        await update.message.reply_text(
+            f'Waiting for a chat partner interested in {", ".join(sorted(tags))}... Type /cancel to stop waiting.'
+        )
+    else:
+        await update.message.reply_text('Waiting for a chat partner... Type /cancel to stop waiting.')
+    if status == 'queued':
+        watch_waiter(user_id)
+
+async def match_fallback_users(context: CallbackContext) -> None:
+    """Pair users who have waited too long for a partner with matching tags."""
+    while (match := await state.match_fallback()) is not None:
+        watch_session(match[0], match[2])
+        await notify_connected(context.bot, *match)
+
+async def notify_connected(bot, user_id, partner_id, pair_id):
+    """Tell both users they are connected, ending the chat if either has blocked the bot."""
+    for chat_id, other_id in ((partner_id, user_id), (user_id, partner_id)):
+        # The chat may already have ended while the other notice was being sent
+        session = await state.partner_of(chat_id)
+        if session is None or tuple(session) != (other_id, pair_id):
+            return
+        try:
+            await bot.send_message(chat_id, 'You are now connected to a chat partner. Type /disconnect to end the chat.')
+        except Forbidden:
+            await end_unreachable_chat(bot, chat_id, other_id, pair_id)
+            return
+        except TelegramError:
+            logger.warning("Could not tell %s about their new chat partner", chat_id)
+
+async def end_unreachable_chat(bot, unreachable_id, user_id, pair_id):
+    """End a chat because unreachable_id blocked the bot and tell the other user."""
+    if await state.unpair(unreachable_id, pair_id) is None:
+        # The chat had already ended
         return
+    with contextlib.suppress(TelegramError):
+        await bot.send_message(user_id, 'Your chat partner is no longer available. Type /connect to find a new one.')
+
+def watch_session(user_id, pair_id):
+    """Check the chat for the idle timeout once it could have gone idle."""
+    if SESSION_IDLE_SECONDS is not None:
+        idle_timers.schedule(('session', user_id, pair_id), SESSION_IDLE_SECONDS)
+
+def watch_waiter(user_id):
+    """Check the waiting user for the waiting timeout once it could have passed."""
+    if WAITING_EXPIRY_SECONDS is not None:
+        idle_timers.schedule(('waiter', user_id), WAITING_EXPIRY_SECONDS)
+
+async def watch_live_sessions():
+    """Start the idle timeouts of the chats and waiting users that outlived a restart."""
+    sessions, waiting = await state.live_sessions()
+    for user_id, pair_id in sessions:
+        watch_session(user_id, pair_id)
+    for user_id in waiting:
+        watch_waiter(user_id)
+
+async def expire_idle_users(context: CallbackContext) -> None:
+    """End chats that have gone idle and stop waits that have lasted too long.
+
+    The timer wheel only says when a chat or a wait could have timed out; the
+    state store decides, atomically. A chat with messages since is checked
+    again when its new idle period could be over, so relaying a message only
+    updates a timestamp and never touches the wheel.
+    """
+    keys = idle_timers.advance()
+    results = await asyncio.gather(*(expire_idle_user(context.bot, key) for key in keys), return_exceptions=True)
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to check %s for the idle timeout", key, exc_info=result)
+            # Try again on a later pass
+            idle_timers.schedule(key, IDLE_CHECK_INTERVAL)
+
+async def expire_idle_user(bot, key):
+    """Apply the idle timeout to one chat or waiting user whose timer has run out."""
+    if key[0] == 'session':
+        _, user_id, pair_id = key
+        status, result = await state.expire_idle(user_id, pair_id, SESSION_IDLE_SECONDS)
+        if status == 'active':
+            idle_timers.schedule(key, result)
+        elif status == 'ended':
+            for chat_id in (user_id, result):
+                with contextlib.suppress(TelegramError):
+                    await bot.send_message(
+                        chat_id, 'Your chat has ended because no messages were sent for a while. Type /connect to find a new chat partner.',
+                        rate_limit_args=PRIORITY_BULK
+                    )
+    else:
+        _, user_id = key
+        status, result = await state.expire_waiter(user_id, WAITING_EXPIRY_SECONDS)
+        if status == 'waiting':
+            idle_timers.schedule(key, result)
+        elif status == 'expired':
+            with contextlib.suppress(TelegramError):
+                await bot.send_message(
+                    user_id, 'No chat partner was found in time, so you have stopped waiting. Type /connect to try again.',
+                    rate_limit_args=PRIORITY_BULK
+                )
 
-    if waiting_users:
-        partner_id = waiting_users.pop()
-        user_pairs[user_id] = partner_id
-        user_pairs[partner_id] = user_id
-
-        # Save chat pair to the database
-        with conn:
-            conn.execute(
-                "INSERT INTO chat_pairs (user1_id, user2_id) VALUES (?, ?)",
-                (user_id, partner_id)
-            )
+async def cancel(update: Update, context: CallbackContext) -> None:
+    """Stop waiting for a chat partner."""
+    user_id = update.message.chat_id
 
-        await update.message.reply_text('You are now connected to a chat partner. Type /disconnect to end the chat.')
-        await context.bot.send_message(partner_id, 'You are now connected to a chat partner. Type /disconnect to end the chat.')
+    if await state.cancel(user_id):
+        await update.message.reply_text('You have stopped waiting for a chat partner.')
     else:
-        waiting_users.append(user_id)
-        await update.message.reply_text('Waiting for a chat partner...')
+        await update.message.reply_text('You are not waiting for a chat partner.')
 
 async def disconnect(update: Update, context: CallbackContext) -> None:
     """Disconnect the user from the chat partner."""
     user_id = update.message.chat_id
 
-    if user_id not in user_pairs:
-        await update.message.reply_text('You are not connected to any chat partner.')
+    if await state.cancel(user_id):
+        await update.message.reply_text('You have stopped waiting for a chat partner.')
         return
 
-    partner_id = user_pairs.pop(user_id)
-    user_pairs.pop(partner_id)
-
-    # Update disconnect time in the database
-    with conn:
-        conn.execute(
-            "UPDATE chat_pairs SET disconnected_at = CURRENT_TIMESTAMP WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-            (user_id, partner_id, partner_id, user_id)
-        )
+    # Deliver an album that is still being collected before the chat ends
+    await albums.flush_user(user_id)
+    partner_id = await state.unpair(user_id)
+    if partner_id is None:
+        await update.message.reply_text('You are not connected to any chat partner.')
+        return
 
     await update.message.reply_text('You have been disconnected.')
-    await context.bot.send_message(partner_id, 'Your chat partner has disconnected.')
+    with contextlib.suppress(TelegramError):
+        await context.bot.send_message(partner_id, 'Your chat partner has disconnected.')
+
+# Message types relayed between partners, in the order a message is checked
+# against them, with the filter that selects each type. Animations are
+# listed before documents because an animation message carries both.
+RELAY_MESSAGE_TYPES = {
+    'text': filters.TEXT & ~filters.COMMAND,
+    'animation': filters.ANIMATION,
+    'photo': filters.PHOTO,
+    'video': filters.VIDEO,
+    'video_note': filters.VIDEO_NOTE,
+    'voice': filters.VOICE,
+    'audio': filters.AUDIO,
+    'document': filters.Document.ALL,
+    'sticker': filters.Sticker.ALL,
+    'dice': filters.Dice.ALL,
+    'poll': filters.POLL,
+    'location': filters.LOCATION,
+    'contact': filters.CONTACT,
+}
+
+# Whether each message type may be sent to a partner. Types set to False are
+# refused with a reply; locations and contacts would reveal who the sender is.
+RELAY_ALLOWED_TYPES = {
+    'text': True,
+    'animation': True,
+    'photo': True,
+    'video': True,
+    'video_note': True,
+    'voice': True,
+    'audio': True,
+    'document': True,
+    'sticker': True,
+    'dice': True,
+    'poll': True,
+    'location': False,
+    'contact': False,
+}
+
+def relay_message_type(message):
+    """Return the RELAY_MESSAGE_TYPES key describing message, or None if it is not relayed."""
+    return next((message_type for message_type in RELAY_MESSAGE_TYPES if getattr(message, message_type)), None)
+
+def relay_file_id(message, message_type):
+    """Return the file_id of the message's attachment, or None if it has no file."""
+    attachment = getattr(message, message_type)
+    if isinstance(attachment, tuple):
+        # Photos come in several sizes, largest last
+        attachment = attachment[-1]
+    return getattr(attachment, 'file_id', None)
+
+# Album settings
+ALBUM_COLLECT_SECONDS = 0.5  # How long to wait for more parts of an album after the last one arrived
+
+# InputMedia class used to resend each message type that can be part of an album
+ALBUM_MEDIA_TYPES = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'document': InputMediaDocument,
+    'audio': InputMediaAudio,
+}
+
+class PendingAlbum:
+    """Parts of one album collected so far, and where to relay them."""
+
+    def __init__(self, bot, user_id, partner_id, pair_id):
+        self.bot = bot
+        self.user_id = user_id
+        self.partner_id = partner_id
+        self.pair_id = pair_id
+        self.parts = []
+        self.timer = None
+
+class AlbumCollector:
+    """Relay each album to the partner with a single send_media_group call.
+
+    Telegram delivers every item of an album as its own update carrying the
+    same media_group_id. Items are held per (user, media_group_id) until no
+    new one has arrived for collect_seconds, then sent in message order and
+    logged in one batch.
+    """
+
+    def __init__(self, collect_seconds):
+        self.collect_seconds = collect_seconds
+        self._albums = {}
+
+    def __len__(self):
+        return len(self._albums)
+
+    def add(self, bot, message, message_type, partner_id, pair_id):
+        """Hold an album item and restart the album's collection window."""
+        key = (message.chat_id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = PendingAlbum(bot, message.chat_id, partner_id, pair_id)
+        else:
+            album.timer.cancel()
+        album.parts.append((message, message_type))
+        album.timer = asyncio.create_task(self._relay_later(key))
+
+    async def flush_user(self, user_id):
+        """Relay the user's pending albums now, so later messages cannot overtake them."""
+        for key in [key for key in self._albums if key[0] == user_id]:
+            album = self._albums.pop(key)
+            album.timer.cancel()
+            await self._relay(album)
+
+    async def flush_all(self):
+        """Relay every pending album."""
+        for key in list(self._albums):
+            album = self._albums.pop(key)
+            album.timer.cancel()
+            await self._relay(album)
+
+    async def _relay_later(self, key):
+        await asyncio.sleep(self.collect_seconds)
+        album = self._albums.pop(key)
+        try:
+            await self._relay(album)
+        except Exception:
+            # Nothing awaits this task, so an error would otherwise go unseen
+            handler_errors.inc('relay_album')
+            logger.exception("Failed to relay album %s of %s to %s", key[1], album.user_id, album.partner_id)
+
+    async def _relay(self, album):
+        session = await state.partner_of(album.user_id)
+        if session is None or session[1] != album.pair_id:
+            # The chat ended while the album was being collected
+            return
+
+        parts = sorted(album.parts, key=lambda part: part[0].message_id)
+        try:
+            if len(parts) == 1:
+                await album.bot.copy_message(album.partner_id, album.user_id, parts[0][0].message_id)
+            else:
+                await album.bot.send_media_group(album.partner_id, [album_media(*part) for part in parts])
+        except Forbidden:
+            await end_unreachable_chat(album.bot, album.partner_id, album.user_id, album.pair_id)
+            return
+        except TelegramError:
+            with contextlib.suppress(TelegramError):
+                await album.bot.send_message(album.user_id, 'Your album could not be delivered to your chat partner.')
+            return
+
+        await state.touch(album.user_id, album.pair_id)
+        await write_messages([
+            (album.pair_id, album.user_id, message.caption, message_type, relay_file_id(message, message_type))
+            for message, message_type in parts
+        ])
+
+def album_media(message, message_type):
+    """Build the InputMedia that resends one album item."""
+    kwargs = {'caption': message.caption, 'caption_entities': message.caption_entities}
+    if message_type in ('photo', 'video'):
+        kwargs['has_spoiler'] = message.has_media_spoiler
+    return ALBUM_MEDIA_TYPES[message_type](relay_file_id(message, message_type), **kwargs)
+
+# Albums waiting for the rest of their items
+albums = AlbumCollector(ALBUM_COLLECT_SECONDS)
 
 async def message_handler(update: Update, context: CallbackContext) -> None:
-    """Forward messages and media between connected users."""
+    """Relay any supported message to the chat partner with a single copy_message call."""
     user_id = update.message.chat_id
 
-    if user_id not in user_pairs:
+    session = await state.partner_of(user_id)
+    if session is None:
         await update.message.reply_text('You are not connected to any chat partner. Type /connect to find a chat partner.')
         return
 
-    partner_id = user_pairs[user_id]
-
-    if update.message.text:
-        message = update.message.text
-        media_type = None
-        media_id = None
-
-        # Save message to the database
-        with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
-            conn.execute(
-                "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
-                (pair_id, user_id, message, media_type, media_id)
-            )
-
-        await context.bot.send_message(partner_id, f"User: {message}")
-
-    elif update.message.photo:
-        media_id = update.message.photo[-1].file_id
-        media_type = 'photo'
-        message = None
-
-        # Save photo to the database
-        with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
-            conn.execute(
-                "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
-                (pair_id, user_id, message, media_type, media_id)
-            )
+    partner_id, pair_id = session
 
-        await context.bot.send_photo(partner_id, media_id)
+    message_type = relay_message_type(update.message)
+    if not RELAY_ALLOWED_TYPES.get(message_type, False):
+        await update.message.reply_text('This type of message cannot be sent to your chat partner.')
+        return
 
-    elif update.message.video:
-        media_id = update.message.video.file_id
-        media_type = 'video'
-        message = None
+    if update.message.media_group_id and message_type in ALBUM_MEDIA_TYPES:
+        albums.add(context.bot, update.message, message_type, partner_id, pair_id)
+        return
+    await albums.flush_user(user_id)
 
-        # Save video to the database
-        with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
-            conn.execute(
-                "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
-                (pair_id, user_id, message, media_type, media_id)
-            )
+    try:
+        # copy_message keeps captions and formatting and hides where the message came from
+        await context.bot.copy_message(partner_id, user_id, update.message.message_id)
+    except Forbidden:
+        await end_unreachable_chat(context.bot, partner_id, user_id, pair_id)
+        return
+    except TelegramError:
+        await update.message.reply_text('Your message could not be delivered to your chat partner.')
+        return
+    await state.touch(user_id, pair_id)
 
-        await context.bot.send_video(partner_id, media_id)
+    # Queue the message for the database
+    if message_type == 'text':
+        await log_message(pair_id, user_id, update.message.text, None, None)
+    else:
+        await log_message(pair_id, user_id, update.message.caption, message_type, relay_file_id(update.message, message_type))
+
+# Report digest settings
+# Seconds between passes that post or update the report cards in ADMIN_GROUP_ID. With several
+# worker processes, enable the digest in one of them only (None disables it) so each card is posted once.
+REPORT_DIGEST_INTERVAL = 30
+REPORT_CARD_REASONS = 10  # Most common reasons listed on a card
+REPORT_REASON_LENGTH = 200  # Reasons are cut to this many characters on a card
+REPORT_CARD_PHOTOS = 10  # Most photos sent when an admin asks for a card's evidence (a media group holds up to 10)
+
+async def report_cards_due():
+    """Return the reported users whose admin group card is out of date."""
+    rows = await db.fetchall(
+        '''
+        SELECT reported_id FROM reports WHERE status = 'pending'
+        GROUP BY reported_id
+        HAVING MAX(id) > COALESCE((SELECT last_report_id FROM report_cards WHERE report_cards.reported_id = reports.reported_id), 0)
+        UNION
+        SELECT reported_id FROM report_cards
+        WHERE NOT EXISTS (SELECT 1 FROM reports WHERE reports.reported_id = report_cards.reported_id AND status = 'pending')
+        '''
+    )
+    return sorted(reported_id for reported_id, in rows)
 
-    elif update.message.animation:
-        media_id = update.message.animation.file_id
-        media_type = 'animation'
-        message = None
+async def update_report_card(bot, reported_id):
+    """Post, edit or close the card of one reported user."""
+    reports = await db.fetchall(
+        "SELECT id, reporter_id, reason, media_id FROM reports WHERE reported_id = ? AND status = 'pending' ORDER BY id",
+        (reported_id,)
+    )
+    card = await db.fetchone("SELECT message_id FROM report_cards WHERE reported_id = ?", (reported_id,))
+    if not reports:
+        # Settled through an older per-report message in the meantime
+        if card is not None:
+            await db.execute("DELETE FROM report_cards WHERE reported_id = ?", (reported_id,))
+            with contextlib.suppress(BadRequest):
+                await bot.edit_message_text(f"No reports against user {reported_id} are pending.", ADMIN_GROUP_ID, card[0])
+        return
 
-        # Save animation (GIF) to the database
-        with conn:
-            cursor = conn.execute(
-                "SELECT id FROM chat_pairs WHERE (user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?)",
-                (user_id, partner_id, partner_id, user_id)
-            )
-            pair_id = cursor.fetchone()[0]
-            conn.execute(
-                "INSERT INTO messages (pair_id, sender_id, message, media_type, media_id) VALUES (?, ?, ?, ?, ?)",
-                (pair_id, user_id, message, media_type, media_id)
-            )
+    text = report_card_text(reported_id, reports)
+    reply_markup = report_card_markup(reported_id, reports)
+    last_report_id = reports[-1][0]
+    if card is not None:
+        try:
+            await bot.edit_message_text(text, ADMIN_GROUP_ID, card[0], reply_markup=reply_markup)
+        except BadRequest as exc:
+            if 'not modified' not in str(exc).lower():
+                # The card was deleted from the group: post a new one
+                card = None
+        if card is not None:
+            await db.execute("UPDATE report_cards SET last_report_id = ? WHERE reported_id = ?", (last_report_id, reported_id))
+            return
+
+    message = await bot.send_message(ADMIN_GROUP_ID, text, reply_markup=reply_markup)
+    await db.execute(
+        '''
+        INSERT INTO report_cards (reported_id, message_id, last_report_id) VALUES (?, ?, ?)
+        ON CONFLICT (reported_id) DO UPDATE SET message_id = excluded.message_id, last_report_id = excluded.last_report_id
+        ''',
+        (reported_id, message.message_id, last_report_id)
+    )
 
-        await context.bot.send_animation(partner_id, media_id)
+async def mark_report_card_stale(reported_id):
+    """Have the next digest redraw the user's card, after one of its reports was settled on its own."""
+    await db.execute("UPDATE report_cards SET last_report_id = 0 WHERE reported_id = ?", (reported_id,))
+
+def report_card_text(reported_id, reports):
+    """Summarize the pending reports against a user for their card."""
+    reporters = {reporter_id for _, reporter_id, _, _ in reports}
+    reasons = collections.Counter((reason or '').strip()[:REPORT_REASON_LENGTH] or '(no reason given)' for _, _, reason, _ in reports)
+    photos = sum(1 for *_, media_id in reports if media_id)
+    first_id, last_id = reports[0][0], reports[-1][0]
+    lines = [
+        f"Reports against user {reported_id}",
+        "",
+        f"Pending: {len(reports)} report{'s' if len(reports) != 1 else ''} from {len(reporters)} user{'s' if len(reporters) != 1 else ''}",
+        f"Report IDs: {first_id}" if first_id == last_id else f"Report IDs: {first_id} to {last_id}",
+    ]
+    if photos:
+        lines.append(f"Photos: {photos}")
+    lines += ["", "Reasons:"]
+    lines += [f"{count} x {reason}" for reason, count in reasons.most_common(REPORT_CARD_REASONS)]
+    if len(reasons) > REPORT_CARD_REASONS:
+        lines.append(f"and {len(reasons) - REPORT_CARD_REASONS} other reasons")
+    return '\n'.join(lines)
+
+def report_card_markup(reported_id, reports):
+    """Buttons that settle the reports shown on a card, and not ones filed after it was drawn."""
+    suffix = f"{reported_id}_{reports[-1][0]}"
+    keyboard = [
+        [InlineKeyboardButton("Accept all", callback_data=f"acceptall_{suffix}"),
+         InlineKeyboardButton("Reject all", callback_data=f"rejectall_{suffix}")]
+    ]
+    if any(media_id for *_, media_id in reports):
+        keyboard.append([InlineKeyboardButton("Show photos", callback_data=f"photos_{suffix}")])
+    return InlineKeyboardMarkup(keyboard)
+
+async def post_report_digest(context: CallbackContext) -> None:
+    """Post or edit in place the admin group card of every reported user whose card is out of date."""
+    for reported_id in await report_cards_due():
+        try:
+            await update_report_card(context.bot, reported_id)
+        except TelegramError:
+            logger.warning("Could not update the report card of %s, trying again next digest", reported_id, exc_info=True)
 
 async def report(update: Update, context: CallbackContext) -> None:
     """Report a user."""
     user_id = update.message.chat_id
-    partner_id = user_pairs.get(user_id)
+    session = await state.partner_of(user_id)
     
-    if partner_id is None:
+    if session is None:
         await update.message.reply_text('You are not connected to any chat partner.')
         return
-    
+
+    partner_id, pair_id = session
     reason = ' '.join(update.message.text.split()[1:])
     media_id = update.message.photo[-1].file_id if update.message.photo else None
 
-    # Save report to the database
-    with report_conn:
-        cursor = report_conn.execute(
-            "INSERT INTO reports (reporter_id, reported_id, reason, media_id) VALUES (?, ?, ?, ?) RETURNING id",
-            (user_id, partner_id, reason, media_id)
-        )
-        report_id = cursor.fetchone()[0]
-    
-    # Send report to admin group
-    keyboard = [
-        [InlineKeyboardButton("Accept", callback_data=f"accept_{report_id}"),
-         InlineKeyboardButton("Reject", callback_data=f"reject_{report_id}")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    report_message = f"New report received!\n\nReport ID: {report_id}\nReporter ID: {user_id}\nReported ID: {partner_id}\nReason: {reason}"
-    if media_id:
-        await context.bot.send_photo(ADMIN_GROUP_ID, media_id, caption=report_message, reply_markup=reply_markup)
-    else:
-        await context.bot.send_message(ADMIN_GROUP_ID, report_message, reply_markup=reply_markup)
+    def file_report(conn):
+        # A user's reports against one user count once while one of them is pending
+        row = conn.execute(
+            "SELECT id FROM reports WHERE reported_id = ? AND reporter_id = ? AND status = 'pending'",
+            (partner_id, user_id)
+        ).fetchone()
+        if row is not None:
+            return row[0], False
+        return conn.execute(
+            "INSERT INTO reports (reporter_id, reported_id, reason, media_id, pair_id) VALUES (?, ?, ?, ?, ?)",
+            (user_id, partner_id, reason, media_id, pair_id)
+        ).lastrowid, True
+
+    # Save report to the database; the admin group sees it in the next digest
+    report_id, filed = await db.transaction(file_report)
+    if not filed:
+        await update.message.reply_text(f'You have already reported this user. Report ID: {report_id} is still pending.')
+        return
 
     await update.message.reply_text(f'Report submitted successfully! Report ID: {report_id}')
 
@@ -394,40 +2683,312 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
 
     callback_data = query.data.split('_')
     action = callback_data[0]
+    if action in ('acceptall', 'rejectall', 'photos'):
+        await handle_report_card(query, context, action, int(callback_data[1]), int(callback_data[2]))
+        return
     report_id = int(callback_data[1])
 
-    with report_conn:
-        cursor = report_conn.execute(
-            "SELECT reporter_id, reported_id FROM reports WHERE id = ?",
-            (report_id,)
-        )
-        report = cursor.fetchone()
+    report = await db.fetchone(
+        "SELECT reporter_id, reported_id, status FROM reports WHERE id = ?",
+        (report_id,)
+    )
 
     if not report:
         await query.edit_message_text(text="Report not found.")
         return
 
-    reporter_id, reported_id = report
+    reporter_id, reported_id, status = report
+
+    if status != 'pending':
+        await query.edit_message_text(text=f"Report {report_id} has already been {status}.")
+        return
 
     if action == 'accept':
-        if 'appeal' in query.data:
-            with conn:
-                conn.execute(
-                    "INSERT INTO banned_users (user_id, reason, banned_until) VALUES (?, ?, ?)",
-                    (reported_id, f"Report ID: {report_id}", None)
-                )
-            await query.edit_message_text(text=f"Report {report_id} has been accepted. User {reported_id} is banned.")
+        def accept_report(conn):
+            # Ban and report state change commit together
+            conn.execute(
+                "INSERT OR REPLACE INTO banned_users (user_id, reason, banned_until) VALUES (?, ?, ?)",
+                (reported_id, f"Report ID: {report_id}", None)
+            )
+            conn.execute("UPDATE reports SET status = 'accepted' WHERE id = ?", (report_id,))
+
+        await db.transaction(accept_report)
+        await apply_ban(context.bot, reported_id, f"Report ID: {report_id}")
+        await mark_report_card_stale(reported_id)
+        await query.edit_message_text(text=f"Report {report_id} has been accepted. User {reported_id} is banned.")
+        with contextlib.suppress(TelegramError):
             await context.bot.send_message(reporter_id, f'Your report (ID: {report_id}) has been accepted.')
 
     elif action == 'reject':
+        await db.execute("UPDATE reports SET status = 'rejected' WHERE id = ?", (report_id,))
+        await mark_report_card_stale(reported_id)
         await query.edit_message_text(text=f"Report {report_id} has been rejected.")
-        if 'appeal' in query.data:
+        with contextlib.suppress(TelegramError):
             await context.bot.send_message(reporter_id, f'Your report (ID: {report_id}) has been rejected.')
-            
-def main() -> None:
-    """Start the bot."""
+
+async def handle_report_card(query, context, action, reported_id, last_report_id):
+    """Settle, or show the photos of, the reports against a user up to the last one on their card."""
+    if action == 'photos':
+        photos = await db.fetchall(
+            '''
+            SELECT id, media_id FROM reports
+            WHERE reported_id = ? AND status = 'pending' AND id <= ? AND media_id IS NOT NULL
+            ORDER BY id LIMIT ?
+            ''',
+            (reported_id, last_report_id, REPORT_CARD_PHOTOS)
+        )
+        if not photos:
+            await context.bot.send_message(ADMIN_GROUP_ID, f"No pending reports against user {reported_id} have photos.")
+        elif len(photos) == 1:
+            await context.bot.send_photo(ADMIN_GROUP_ID, photos[0][1], caption=f"Report {photos[0][0]}")
+        else:
+            await context.bot.send_media_group(
+                ADMIN_GROUP_ID, [InputMediaPhoto(media_id, caption=f"Report {report_id}") for report_id, media_id in photos]
+            )
+        return
+
+    status = 'accepted' if action == 'acceptall' else 'rejected'
+
+    def settle_reports(conn):
+        reports = conn.execute(
+            "SELECT id, reporter_id FROM reports WHERE reported_id = ? AND status = 'pending' AND id <= ? ORDER BY id",
+            (reported_id, last_report_id)
+        ).fetchall()
+        if not reports:
+            return reports, None
+        ban_reason = None
+        if status == 'accepted':
+            ban_reason = f"Report ID: {reports[0][0]}" if len(reports) == 1 else f"Report IDs: {reports[0][0]} to {reports[-1][0]}"
+            conn.execute(
+                "INSERT OR REPLACE INTO banned_users (user_id, reason, banned_until) VALUES (?, ?, ?)",
+                (reported_id, ban_reason, None)
+            )
+        conn.execute(
+            "UPDATE reports SET status = ? WHERE reported_id = ? AND status = 'pending' AND id <= ?",
+            (status, reported_id, last_report_id)
+        )
+        # Reports filed after the card was drawn get a new card in the next digest
+        conn.execute("DELETE FROM report_cards WHERE reported_id = ?", (reported_id,))
+        return reports, ban_reason
+
+    reports, ban_reason = await db.transaction(settle_reports)
+    if not reports:
+        # Already settled from this card, which says how, or from another one
+        return
+    if ban_reason is not None:
+        await apply_ban(context.bot, reported_id, ban_reason)
+
+    count = f"{len(reports)} report{'s' if len(reports) != 1 else ''}"
+    if status == 'accepted':
+        await query.edit_message_text(text=f"{count} against user {reported_id} accepted. User {reported_id} is banned.")
+    else:
+        await query.edit_message_text(text=f"{count} against user {reported_id} rejected.")
+    # A raid can leave many reporters to tell; that should not hold up the admin group's next update
+    context.application.create_task(notify_reporters(context.bot, reports, status))
+
+async def notify_reporters(bot, reports, status):
+    """Tell every reporter how their report was settled."""
+    for report_id, reporter_id in reports:
+        with contextlib.suppress(TelegramError):
+            await bot.send_message(reporter_id, f'Your report (ID: {report_id}) has been {status}.', rate_limit_args=PRIORITY_BULK)
+
+class AdmittingUpdateQueue(asyncio.Queue):
+    """Update queue that hands out an update only while fewer than max_admitted are being handled."""
+
+    def __init__(self, maxsize, max_admitted):
+        super().__init__(maxsize)
+        self.max_admitted = max_admitted
+        self.admitted = 0
+        self._admission = asyncio.Semaphore(max_admitted)
+
+    async def get(self):
+        await self._admission.acquire()
+        try:
+            update = await super().get()
+        except BaseException:
+            self._admission.release()
+            raise
+        if type(update) is object:
+            # The Application's stop signal is a bare object() and is never processed
+            self._admission.release()
+        else:
+            self.admitted += 1
+        return update
+
+    def release(self):
+        """Free the admission of an update that has been handled."""
+        self.admitted -= 1
+        self._admission.release()
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates from different chats concurrently, in order within a chat and a pair.
+
+    Chat locks are always taken before pair locks, and an update only takes a slot once it holds its locks.
+    """
+
+    def __init__(self, max_concurrent_updates, update_queue):
+        # The base class's semaphore is never the limit: update_queue bounds the updates in flight
+        super().__init__(update_queue.max_admitted)
+        self._update_queue = update_queue
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}  # key -> [asyncio.Lock, number of updates holding or waiting for it]
+
+    @contextlib.asynccontextmanager
+    async def _hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            await coroutine
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            self._update_queue.release()
+
+    async def _process_in_order(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._run(coroutine)
+            return
+
+        async with self._hold(('chat', chat.id)):
+            session = None
+            if chat.type == chat.PRIVATE:
+                try:
+                    session = await state.partner_of(chat.id)
+                except Exception:
+                    logger.exception("Could not look up the chat session of %s", chat.id)
+            if session is None:
+                await self._run(coroutine)
+                return
+            async with self._hold(('pair', session[1])):
+                await self._run(coroutine)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+def instrumented(callback):
+    """Wrap a handler or job callback so its run time and exceptions are recorded.
+
+    With PROFILE_UPDATES, the time is also split into database and Bot API
+    time, and calls slower than SLOW_UPDATE_SECONDS are logged.
+    """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args):
+        profile = UpdateProfile() if PROFILE_UPDATES else None
+        token = current_profile.set(profile)
+        started = time.perf_counter()
+        try:
+            return await callback(*args)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            current_profile.reset(token)
+            handler_seconds.observe(elapsed, name)
+            if profile is not None:
+                handler_db_seconds.observe(profile.db_time, name)
+                handler_api_seconds.observe(profile.api_time, name)
+                if elapsed >= SLOW_UPDATE_SECONDS:
+                    log_slow_update(name, args[0], elapsed, profile)
+    return wrapper
+
+def log_slow_update(name, update, elapsed, profile):
+    """Log where the time of a slow handler call went."""
+    update_id = update.update_id if isinstance(update, Update) else None
+    other = max(0.0, elapsed - profile.db_time - profile.api_time)
+    logger.warning(
+        "Slow update %s in %s: %.0fms total, %.0fms database (%d calls), %.0fms Bot API (%d calls), %.0fms other",
+        update_id, name, elapsed * 1000, profile.db_time * 1000, profile.db_calls,
+        profile.api_time * 1000, profile.api_calls, other * 1000
+    )
+
+async def waiting_users_count():
+    return (await state.counts())[0]
+
+async def report_cards_due_count():
+    return len(await report_cards_due())
+
+async def active_pairs_count():
+    return (await state.counts())[1]
+
+# Gauges, read each time the metrics endpoint is scraped
+metrics.gauge('waiting_users', 'Users waiting for a chat partner.', waiting_users_count)
+metrics.gauge('active_pairs', 'Chat sessions in progress.', active_pairs_count)
+metrics.gauge('relay_backlog', 'Outbound sends waiting for their turn under the rate limits.', lambda: sum(outbox.queued.values()))
+metrics.gauge('sends_in_flight', 'Outbound sends being delivered, including retries.', lambda: outbox.stats()['in_flight'])
+metrics.gauge('pending_albums', 'Albums still being collected before they are relayed.', lambda: len(albums))
+metrics.gauge('message_log_backlog', 'Message records waiting to be written to the database.', lambda: message_queue.qsize())
+metrics.gauge('report_cards_due', 'Reported users whose admin group card is updated in the next digest.', report_cards_due_count)
+metrics.gauge('idle_timers', 'Chats and waiting users with an idle timeout pending.', lambda: len(idle_timers))
+pending_updates = metrics.gauge('pending_updates', 'Updates received but not yet handled.', lambda: 0)
+
+# Server for the metrics endpoint, started by post_init
+metrics_server = None
+
+async def start_metrics_server() -> None:
+    """Serve the metrics endpoint if METRICS_PORT is set."""
+    global metrics_server
+    if METRICS_PORT is None:
+        return
+    try:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+    except OSError:
+        # Usually another worker process on this host already has the port; the bot runs on without the endpoint
+        logger.exception("Could not serve metrics on %s:%s", METRICS_LISTEN, METRICS_PORT)
+        return
+    host, port = metrics_server.sockets[0].getsockname()[:2]
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+async def stop_metrics_server() -> None:
+    """Stop serving the metrics endpoint."""
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+def build_application() -> Application:
+    """Create the Application and register every handler and job."""
+    # Updates being handled count against the queue too, so intake slows down once the bot falls behind
+    update_queue = AdmittingUpdateQueue(UPDATE_QUEUE_SIZE, UPDATE_CONCURRENCY + UPDATE_QUEUE_SIZE)
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token("YOUR_TOKEN_HERE").build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .update_queue(update_queue)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, update_queue))
+        .rate_limiter(outbox)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(close_database)
+        .build()
+    )
+
+    # Banned users are turned away before any other handler runs
+    application.add_handler(TypeHandler(Update, reject_banned_users), group=-1)
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -437,19 +2998,72 @@ def main() -> None:
     application.add_handler(CommandHandler("delsudo", del_sudo))
     application.add_handler(CommandHandler("ban", ban_user))
     application.add_handler(CommandHandler("unban", unban_user))
+    application.add_handler(CommandHandler("sendqueue", send_queue))
+    application.add_handler(CommandHandler("deadletters", dead_letters))
+    application.add_handler(CommandHandler("replay", replay_dead_letter))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(CommandHandler("connect", connect))
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("disconnect", disconnect))
     application.add_handler(CommandHandler("report", report))
     application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_error_handler(error_handler)
 
     # on non command i.e message - forward the message or media to the chat partner
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, message_handler))
-    application.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, message_handler))
-    application.add_handler(MessageHandler(filters.VIDEO & filters.ChatType.PRIVATE, message_handler))
-    application.add_handler(MessageHandler(filters.ANIMATION & filters.ChatType.PRIVATE, message_handler))
+    relay_filter = functools.reduce(operator.or_, RELAY_MESSAGE_TYPES.values())
+    application.add_handler(MessageHandler(relay_filter & filters.UpdateType.MESSAGE & filters.ChatType.PRIVATE, message_handler))
+
+    # Time every handler for the metrics endpoint
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrumented(handler.callback)
+    pending_updates.read = lambda: update_queue.qsize() + update_queue.admitted
+
+    # Pair users who have waited past the tag matching threshold
+    if MATCH_FALLBACK_SECONDS is not None:
+        application.job_queue.run_repeating(instrumented(match_fallback_users), interval=MATCH_FALLBACK_INTERVAL)
+
+    # End idle chats and stale waits
+    if SESSION_IDLE_SECONDS is not None or WAITING_EXPIRY_SECONDS is not None:
+        application.job_queue.run_repeating(instrumented(expire_idle_users), interval=IDLE_CHECK_INTERVAL)
+
+    # Post the reports filed since the last digest to the admin group
+    if REPORT_DIGEST_INTERVAL is not None:
+        application.job_queue.run_repeating(instrumented(post_report_digest), interval=REPORT_DIGEST_INTERVAL)
+
+    # Other worker processes can ban users and change sudo users
+    if STATE_BACKEND != 'memory':
+        application.job_queue.run_repeating(instrumented(refresh_caches), interval=CACHE_REFRESH_INTERVAL)
+
+    # Keep a recent snapshot of the waiting queue for warm restarts
+    if STATE_BACKEND == 'memory':
+        application.job_queue.run_repeating(instrumented(save_state_snapshot), interval=SNAPSHOT_INTERVAL)
+
+    # Archive and delete the messages of chats past the retention period
+    if MESSAGE_RETENTION_DAYS is not None:
+        application.job_queue.run_repeating(instrumented(enforce_retention), interval=RETENTION_INTERVAL, first=60)
+
+    return application
+
+def main() -> None:
+    """Start the bot."""
+    application = build_application()
 
     # Start the Bot
-    application.run_polling()
+    if UPDATE_MODE == 'webhook':
+        # Telegram sends WEBHOOK_SECRET_TOKEN with every update; requests without it are rejected
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    elif UPDATE_MODE == 'polling':
+        application.run_polling()
+    else:
+        raise ValueError(f"Unknown update mode: {UPDATE_MODE}")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,230 @@
+"""Shared pieces for the local benchmark tools.
+
+FakeBotAPI is a small stand-in for the Telegram Bot API HTTP server. It
+answers the calls the bot makes, serves synthetic updates through getUpdates
+and records when every call arrived, so the tools can measure the bot
+without talking to Telegram.
+"""
+import importlib.util
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_PATH = pathlib.Path(__file__).resolve().parent.parent / 'RandomTalker [v5.0].py'
+BOT_ID = 4242424242
+
+def load_bot(workdir=None):
+    """Import the bot script as a module, with its database in workdir (a new temporary directory by default)."""
+    os.chdir(workdir or tempfile.mkdtemp(prefix='randomtalker-bench-'))
+    spec = importlib.util.spec_from_file_location('randomtalker', BOT_PATH)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    # Any free port, so several tools can run side by side
+    bot.METRICS_PORT = 0
+    return bot
+
+def percentile(values, p):
+    """Return the p-th percentile of values (nearest rank), or 0.0 if there are none."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def make_message_update(update_id, user_id, text=None, message_id=1, **fields):
+    """Build the JSON of a private-chat message update as Telegram would send it."""
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    message.update(fields)
+    return {'update_id': update_id, 'message': message}
+
+class FakeBotAPI:
+    """Local HTTP server that answers Bot API calls and records them.
+
+    Every call is appended to calls as (method, chat_id, perf_counter time) and
+    passed to the registered listeners, together with the call's parameters,
+    from the server thread. response_delay
+    adds a fixed delay to every send call to mimic the round trip to Telegram.
+    """
+
+    SEND_METHODS = {
+        'sendMessage', 'sendPhoto', 'sendVideo', 'sendAnimation', 'sendAudio', 'sendDocument',
+        'sendVoice', 'sendVideoNote', 'sendSticker', 'sendLocation', 'sendContact', 'sendPoll',
+        'sendDice', 'copyMessage', 'forwardMessage', 'editMessageText', 'editMessageCaption',
+    }
+
+    def __init__(self, host='127.0.0.1', port=0, response_delay=0.0):
+        self.response_delay = response_delay
+        self.calls = []
+        self.listeners = []
+        self._updates = []
+        self._updates_changed = threading.Condition()
+        self._message_ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        # The bot drops its long-polling connection on shutdown; that is not worth a traceback
+        self.server.handle_error = lambda request, client_address: None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._updates_changed:
+            self._updates_changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        """Queue an update for the bot's next getUpdates call."""
+        with self._updates_changed:
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+
+    def count(self, method=None):
+        """Return how many calls were recorded, optionally only for one method."""
+        with self._lock:
+            return sum(1 for call in self.calls if method is None or call[0] == method)
+
+    def _record(self, method, params):
+        chat_id = params.get('chat_id')
+        entry = (method, int(chat_id) if chat_id is not None else None, time.perf_counter())
+        with self._lock:
+            self.calls.append(entry)
+        for listener in self.listeners:
+            listener(*entry, params)
+
+    def _message(self, params, **fields):
+        with self._lock:
+            message_id = next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+        }
+        message.update(fields)
+        return message
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._updates_changed:
+            while True:
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+                if self._updates or time.monotonic() >= deadline:
+                    return self._updates[:limit]
+                self._updates_changed.wait(deadline - time.monotonic())
+
+    def _answer(self, method, params):
+        if method == 'getMe':
+            return {
+                'id': BOT_ID, 'is_bot': True, 'first_name': 'RandomTalker', 'username': 'random_talker_bench_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False,
+            }
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method not in self.SEND_METHODS and method not in ('sendMediaGroup', 'copyMessages'):
+            return True
+
+        self._record(method, params)
+        if self.response_delay:
+            time.sleep(self.response_delay)
+        if method == 'sendMediaGroup':
+            return [self._message(params) for _ in json.loads(params.get('media', '[]'))]
+        if method == 'copyMessages':
+            return [{'message_id': self._message(params)['message_id']} for _ in json.loads(params.get('message_ids', '[]'))]
+        if method == 'copyMessage':
+            return {'message_id': self._message(params)['message_id']}
+        if 'text' in params:
+            return self._message(params, text=params['text'])
+        return self._message(params)
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = {key: value if isinstance(value, str) else json.dumps(value) for key, value in json.loads(body or b'{}').items()}
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                payload = json.dumps({'ok': True, 'result': api._answer(method, params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def lift_send_limits(bot):
+    """Raise the bot's outbound rate limits so a benchmark measures the bot rather than the throttle."""
+    bot.SEND_GLOBAL_RATE = bot.SEND_CHAT_RATE = bot.SEND_GROUP_RATE = 1_000_000
+    bot.SEND_CHAT_BURST = bot.SEND_GROUP_BURST = 1_000_000
+    bot.outbox = bot.OutboundScheduler()
+
+async def start_bot(bot, api, mode='polling', webhook_port=None):
+    """Build the bot's Application against api and start receiving updates in mode."""
+    bot.BOT_API_BASE_URL = api.base_url
+    application = bot.build_application()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    if mode == 'webhook':
+        url = f'http://127.0.0.1:{webhook_port}/{bot.WEBHOOK_PATH}'
+        await application.updater.start_webhook(
+            listen='127.0.0.1',
+            port=webhook_port,
+            url_path=bot.WEBHOOK_PATH,
+            webhook_url=url,
+            secret_token=bot.WEBHOOK_SECRET_TOKEN,
+        )
+    else:
+        await application.updater.start_polling(poll_interval=0.0, timeout=1)
+    return application
+
+async def stop_bot(bot, application):
+    """Stop the Application the same way run_polling/run_webhook would."""
+    if application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
@@ -0,0 +1,217 @@
+"""Load test that simulates concurrent users chatting through the bot.
+
+Starts the bot against the local Bot API stand-in and runs N simulated users.
+Each one loops through /connect, a short conversation with whoever it was
+paired with, and /disconnect. Every user waits for the bot's answer before
+its next step, like a real client would. Reports updates per second, relay
+latency percentiles (from a message entering the bot to the copy reaching
+the partner's chat), database write time and memory use.
+
+    python bench/loadtest.py --users 200 --duration 30 --unthrottled
+    python bench/loadtest.py --users 50 --messages 20 --mode webhook
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import random
+import resource
+import socket
+import time
+
+import httpx
+
+from harness import FakeBotAPI, lift_send_limits, load_bot, make_message_update, percentile, start_bot, stop_bot
+
+FIRST_USER_ID = 200000
+REPLY_TIMEOUT = 10.0  # Seconds a simulated user waits for the bot before it starts over
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def time_database_writes(db):
+    """Record how long every write transaction takes on the writer thread."""
+    timings = []
+    run = db.run
+
+    def timed(func):
+        def timed_func(conn, *args):
+            started = time.perf_counter()
+            try:
+                return func(conn, *args)
+            finally:
+                timings.append(time.perf_counter() - started)
+        return timed_func
+
+    db.run = lambda func, *args: run(timed(func), *args)
+    return timings
+
+class Stats:
+    def __init__(self):
+        self.updates = 0
+        self.relayed = 0
+        self.sessions = 0
+        self.timeouts = 0
+        self.latencies = []
+
+class UpdateSender:
+    """Deliver updates to the bot through getUpdates or its webhook server."""
+
+    def __init__(self, api, mode, webhook_url=None, secret=None):
+        self.api = api
+        self.mode = mode
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=100)) if mode == 'webhook' else None
+        self.update_ids = itertools.count(1)
+
+    async def send(self, update):
+        if self.mode == 'webhook':
+            await self.client.post(self.webhook_url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': self.secret})
+        else:
+            self.api.push_update(update)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+class SimulatedUser:
+    """One user looping through connect, chat and disconnect."""
+
+    def __init__(self, user_id, sender, stats, args, stop):
+        self.user_id = user_id
+        self.sender = sender
+        self.stats = stats
+        self.args = args
+        self.stop = stop
+        self.inbox = asyncio.Queue()  # ('text', text) for bot messages, ('delivered', message_id) for relays
+        self.message_ids = itertools.count(1)
+        self.sent_at = {}
+
+    async def send(self, text):
+        message_id = next(self.message_ids)
+        self.sent_at[message_id] = time.perf_counter()
+        await self.sender.send(make_message_update(next(self.sender.update_ids), self.user_id, text, message_id))
+        self.stats.updates += 1
+        return message_id
+
+    async def expect(self, predicate):
+        """Wait for an inbox event matching predicate; return it, or None on timeout or stop."""
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while not self.stop.is_set():
+            try:
+                event = await asyncio.wait_for(self.inbox.get(), min(0.5, max(0.0, deadline - time.monotonic())))
+            except asyncio.TimeoutError:
+                if time.monotonic() >= deadline:
+                    self.stats.timeouts += 1
+                    return None
+                continue
+            if predicate(event):
+                return event
+        return None
+
+    async def run(self):
+        while not self.stop.is_set():
+            await self.send('/connect')
+            connected = await self.expect(lambda event: event[0] == 'text' and event[1].startswith('You are now connected'))
+            if connected is None:
+                continue
+            self.stats.sessions += 1
+
+            partner_left = False
+            for _ in range(self.args.messages):
+                if self.stop.is_set():
+                    return
+                message_id = await self.send(f'hello {random.random()}')
+                event = await self.expect(lambda event: event == ('delivered', message_id) or (
+                    event[0] == 'text' and event[1].startswith(('Your chat partner has disconnected', 'You are not connected'))
+                ))
+                if event is None or event[0] == 'text':
+                    partner_left = True
+                    break
+                if self.args.think_time:
+                    await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+
+            if not partner_left:
+                await self.send('/disconnect')
+                await self.expect(lambda event: event[0] == 'text' and event[1].startswith((
+                    'You have been disconnected', 'You are not connected', 'Your chat partner has disconnected'
+                )))
+
+async def run(args):
+    bot = load_bot()
+    if args.unthrottled:
+        lift_send_limits(bot)
+    write_timings = time_database_writes(bot.db)
+    api = FakeBotAPI(response_delay=args.api_delay).start()
+    webhook_port = free_port()
+    application = await start_bot(bot, api, mode=args.mode, webhook_port=webhook_port)
+
+    stats = Stats()
+    stop = asyncio.Event()
+    users = {}
+    sender = UpdateSender(
+        api, args.mode,
+        webhook_url=f'http://127.0.0.1:{webhook_port}/{bot.WEBHOOK_PATH}',
+        secret=bot.WEBHOOK_SECRET_TOKEN,
+    )
+    loop = asyncio.get_running_loop()
+
+    def deliver(user, event, timestamp=None):
+        if event[0] == 'delivered':
+            sent_at = user.sent_at.pop(event[1], None)
+            if sent_at is not None:
+                stats.relayed += 1
+                stats.latencies.append((timestamp - sent_at) * 1000)
+        user.inbox.put_nowait(event)
+
+    def on_call(method, chat_id, timestamp, params):
+        # Runs on the fake API's server threads
+        if method == 'sendMessage' and chat_id in users:
+            loop.call_soon_threadsafe(deliver, users[chat_id], ('text', params.get('text', '')))
+        elif method == 'copyMessage':
+            sender_id = int(params.get('from_chat_id', 0))
+            if sender_id in users:
+                loop.call_soon_threadsafe(deliver, users[sender_id], ('delivered', int(params['message_id'])), timestamp)
+
+    api.listeners.append(on_call)
+    for i in range(args.users):
+        user_id = FIRST_USER_ID + i
+        users[user_id] = SimulatedUser(user_id, sender, stats, args, stop)
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(user.run()) for user in users.values()]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*tasks)
+
+    await sender.close()
+    await stop_bot(bot, application)
+    api.stop()
+
+    write_ms = [timing * 1000 for timing in write_timings]
+    print(f'mode: {args.mode}, users: {args.users}, duration: {elapsed:.1f}s, messages per chat: {args.messages}')
+    print(f'updates sent: {stats.updates} ({stats.updates / elapsed:.0f} updates/s)')
+    print(f'messages relayed: {stats.relayed} ({stats.relayed / elapsed:.0f}/s), chats started: {stats.sessions}, timeouts: {stats.timeouts}')
+    print(f'relay latency ms: p50 {percentile(stats.latencies, 50):.1f}  p95 {percentile(stats.latencies, 95):.1f}  p99 {percentile(stats.latencies, 99):.1f}')
+    print(f'db writes: {len(write_ms)} transactions, {sum(write_ms):.0f}ms total, '
+          f'p50 {percentile(write_ms, 50):.2f}  p95 {percentile(write_ms, 95):.2f}  p99 {percentile(write_ms, 99):.2f} ms')
+    print(f'api calls: {len(api.calls)} ({collections.Counter(call[0] for call in api.calls).most_common(4)})')
+    print(f'peak memory (RSS): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100, help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds to run the load for')
+    parser.add_argument('--messages', type=int, default=10, help='messages each user sends per chat')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean seconds a user pauses between messages')
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--api-delay', type=float, default=0.0, help='seconds the fake Bot API takes per send')
+    parser.add_argument('--unthrottled', action='store_true', help="lift the bot's outbound rate limits")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
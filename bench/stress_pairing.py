@@ -0,0 +1,201 @@
+"""Stress test for the matchmaking state transitions.
+
+Fires thousands of concurrent connect, cancel, disconnect and fallback
+matching calls at a state store, with random delays injected into every
+database call so the transitions interleave in as many ways as possible.
+Afterwards it checks that the live state is consistent and agrees with the
+open chat_pairs rows, and exits with status 1 if it is not.
+
+    python bench/stress_pairing.py --backend memory --users 2000 --operations 50000
+    python bench/stress_pairing.py --backend sqlite --users 500 --operations 5000
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from harness import load_bot
+
+TAGS = ('music', 'games', 'en', 'de', 'movies')
+
+def add_database_jitter(db, max_delay):
+    """Delay every database call by a random amount before it is handed to its thread."""
+    run, read = db.run, db.read
+
+    async def jittered_run(func, *args):
+        await asyncio.sleep(random.uniform(0, max_delay))
+        return await run(func, *args)
+
+    async def jittered_read(func, *args):
+        await asyncio.sleep(random.uniform(0, max_delay))
+        return await read(func, *args)
+
+    db.run, db.read = jittered_run, jittered_read
+
+class Recorder:
+    """What the operations observed, checked once they have all finished."""
+
+    def __init__(self):
+        self.started_pairs = {}  # pair_id -> the two user IDs
+        self.errors = []
+        self.counts = {}
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def started(self, pair_id, user_id, partner_id):
+        if pair_id in self.started_pairs:
+            self.errors.append(f'pair {pair_id} was started twice')
+        if user_id == partner_id:
+            self.errors.append(f'user {user_id} was paired with themselves')
+        self.started_pairs[pair_id] = {user_id, partner_id}
+
+async def user_operation(state, recorder, user_id, stale_sessions):
+    action = random.random()
+    if action < 0.45:
+        tags = frozenset(random.sample(TAGS, random.randint(0, 2)))
+        status, partner_id, pair_id = await state.match_or_enqueue(user_id, tags)
+        recorder.count(f'connect:{status}')
+        if status == 'matched':
+            recorder.started(pair_id, user_id, partner_id)
+            stale_sessions.append((user_id, pair_id))
+    elif action < 0.55:
+        recorder.count(f'cancel:{await state.cancel(user_id)}')
+    elif action < 0.85:
+        partner_id = await state.unpair(user_id)
+        recorder.count('disconnect:' + ('ended' if partner_id is not None else 'none'))
+    elif action < 0.95 and stale_sessions:
+        # A late caller holding an old session, like a send that failed after the chat moved on
+        stale_user_id, stale_pair_id = random.choice(stale_sessions)
+        session = await state.partner_of(stale_user_id)
+        partner_id = await state.unpair(stale_user_id, stale_pair_id)
+        if partner_id is not None and (session is None or session[1] != stale_pair_id) and await state.partner_of(stale_user_id) is not None:
+            recorder.errors.append(f'stale unpair of {stale_pair_id} ended a newer chat of {stale_user_id}')
+        recorder.count('stale_unpair:' + ('ended' if partner_id is not None else 'none'))
+    else:
+        match = await state.match_fallback()
+        recorder.count('fallback:' + ('matched' if match else 'none'))
+        if match:
+            recorder.started(match[2], match[0], match[1])
+            stale_sessions.append((match[0], match[2]))
+
+async def run_operation(state, recorder, user_id, stale_sessions):
+    try:
+        await user_operation(state, recorder, user_id, stale_sessions)
+    except Exception as exc:
+        recorder.errors.append(f'{type(exc).__name__} for user {user_id}: {exc}')
+
+def check_memory_state(state, errors):
+    sessions = state.sessions
+    for user_id, (partner_id, pair_id) in sessions.items():
+        if sessions.get(partner_id) != (user_id, pair_id):
+            errors.append(f'user {user_id} is paired with {partner_id} in pair {pair_id}, but not the other way around')
+        if user_id in state.waiting_users:
+            errors.append(f'user {user_id} is both paired and waiting')
+
+    if set(state.last_active) != {pair_id for _, pair_id in sessions.values()}:
+        errors.append('last activity is tracked for a different set of sessions than the live ones')
+
+    queue = state.waiting_users
+    indexed = set(queue._untagged)
+    for tag, waiting in queue._by_tag.items():
+        for user_id in waiting:
+            if tag not in queue._waiting.get(user_id, (None, ()))[1]:
+                errors.append(f'tag index {tag!r} lists user {user_id}, who is not waiting with that tag')
+            indexed.add(user_id)
+    if indexed != set(queue._waiting):
+        errors.append('the tag indexes and the waiting queue disagree')
+    return {(user_id, partner_id, pair_id) for user_id, (partner_id, pair_id) in sessions.items()}
+
+def check_sqlite_state(db, errors):
+    rows = db.call(lambda conn: conn.execute("SELECT user_id, partner_id, pair_id FROM live_pairs").fetchall())
+    sessions = {user_id: (partner_id, pair_id) for user_id, partner_id, pair_id in rows}
+    for user_id, (partner_id, pair_id) in sessions.items():
+        if sessions.get(partner_id) != (user_id, pair_id):
+            errors.append(f'user {user_id} is paired with {partner_id} in pair {pair_id}, but not the other way around')
+    waiting = {row[0] for row in db.call(lambda conn: conn.execute("SELECT user_id FROM live_waiting").fetchall())}
+    for user_id in waiting & set(sessions):
+        errors.append(f'user {user_id} is both paired and waiting')
+    tagged = {row[0] for row in db.call(lambda conn: conn.execute("SELECT DISTINCT user_id FROM live_waiting_tags").fetchall())}
+    if tagged - waiting:
+        errors.append(f'{len(tagged - waiting)} users have tags but are not waiting')
+    return {(user_id, partner_id, pair_id) for user_id, (partner_id, pair_id) in sessions.items()}
+
+def check_chat_pairs(db, live, recorder):
+    errors = recorder.errors
+    open_rows = db.call(lambda conn: conn.execute(
+        "SELECT id, user1_id, user2_id FROM chat_pairs WHERE disconnected_at IS NULL"
+    ).fetchall())
+    live_pair_ids = {pair_id for _, _, pair_id in live}
+    open_pair_ids = {pair_id for pair_id, _, _ in open_rows}
+    if live_pair_ids != open_pair_ids:
+        errors.append(
+            f'{len(open_pair_ids - live_pair_ids)} open chat_pairs rows have no live pair and '
+            f'{len(live_pair_ids - open_pair_ids)} live pairs have no open row'
+        )
+    seen = {}
+    for pair_id, user1_id, user2_id in open_rows:
+        for user_id in (user1_id, user2_id):
+            if user_id in seen:
+                errors.append(f'user {user_id} is in open sessions {seen[user_id]} and {pair_id}')
+            seen[user_id] = pair_id
+        if recorder.started_pairs.get(pair_id, {user1_id, user2_id}) != {user1_id, user2_id}:
+            errors.append(f'chat_pairs row {pair_id} does not match the pair that was started')
+
+async def run(args):
+    bot = load_bot()
+    if args.backend == 'sqlite':
+        state = bot.SQLiteStateStore(bot.db, fallback_after=args.fallback_after)
+    else:
+        state = bot.MemoryStateStore()
+        state.waiting_users.fallback_after = args.fallback_after
+    bot.state = state
+    await state.load()
+    add_database_jitter(bot.db, args.jitter)
+
+    recorder = Recorder()
+    stale_sessions = []
+    started = time.perf_counter()
+    for offset in range(0, args.operations, args.batch):
+        await asyncio.gather(*(
+            run_operation(state, recorder, random.randrange(args.users), stale_sessions)
+            for _ in range(min(args.batch, args.operations - offset))
+        ))
+    elapsed = time.perf_counter() - started
+
+    if args.backend == 'sqlite':
+        live = check_sqlite_state(bot.db, recorder.errors)
+    else:
+        live = check_memory_state(state, recorder.errors)
+    check_chat_pairs(bot.db, live, recorder)
+    waiting, pairs = await state.counts()
+    bot.db.close()
+
+    print(f'backend: {args.backend}, users: {args.users}, operations: {args.operations} in batches of {args.batch}')
+    print(f'{elapsed:.2f}s ({args.operations / elapsed:.0f} operations/s)')
+    print('outcomes: ' + ', '.join(f'{name} {count}' for name, count in sorted(recorder.counts.items())))
+    print(f'chats started: {len(recorder.started_pairs)}, live pairs: {pairs}, waiting: {waiting}')
+    if recorder.errors:
+        print(f'{len(recorder.errors)} problems found:')
+        for error in recorder.errors[:20]:
+            print(f'  {error}')
+        return 1
+    print('state is consistent')
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=2000, help='operations in flight at once')
+    parser.add_argument('--jitter', type=float, default=0.002, help='maximum delay injected before each database call')
+    parser.add_argument('--fallback-after', type=float, default=0.0, help='seconds before tagged users match anyone')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == '__main__':
+    main()
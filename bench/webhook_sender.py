@@ -0,0 +1,112 @@
+"""Stand-in update sender for comparing webhook and polling intake.
+
+Starts the bot against a local Bot API stand-in and delivers synthetic /start
+updates, either by POSTing them to the bot's webhook server the way Telegram
+does in webhook mode, or by serving them through getUpdates in polling mode.
+Reports intake throughput and the latency from sending an update to the bot's
+reply reaching the API.
+
+    python bench/webhook_sender.py --mode webhook --updates 2000 --concurrency 50
+    python bench/webhook_sender.py --mode polling --updates 2000
+"""
+import argparse
+import asyncio
+import socket
+import threading
+import time
+
+import httpx
+
+from harness import FakeBotAPI, lift_send_limits, load_bot, make_message_update, percentile, start_bot, stop_bot
+
+FIRST_USER_ID = 100000
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def send_webhook_updates(url, secret, updates, concurrency, sent_at):
+    """POST every update to the webhook server and return the number of rejected requests."""
+    semaphore = asyncio.Semaphore(concurrency)
+    rejected = 0
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(update):
+            nonlocal rejected
+            async with semaphore:
+                sent_at[update['message']['chat']['id']] = time.perf_counter()
+                response = await client.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+                if response.status_code != 200:
+                    rejected += 1
+
+        # A request with the wrong secret must be refused before it reaches the update queue
+        response = await client.post(url, json=make_message_update(0, 1, '/start'), headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+        print(f'request with a wrong secret token: HTTP {response.status_code}')
+        await asyncio.gather(*(post(update) for update in updates))
+    return rejected
+
+async def run(args):
+    bot = load_bot()
+    if args.unthrottled:
+        lift_send_limits(bot)
+    api = FakeBotAPI(response_delay=args.api_delay).start()
+    webhook_port = free_port()
+    application = await start_bot(bot, api, mode=args.mode, webhook_port=webhook_port)
+
+    sent_at = {}
+    replied_at = {}
+    done = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    lock = threading.Lock()
+
+    def on_call(method, chat_id, timestamp, params):
+        if method != 'sendMessage' or chat_id not in sent_at:
+            return
+        with lock:
+            replied_at.setdefault(chat_id, timestamp)
+            if len(replied_at) == args.updates:
+                loop.call_soon_threadsafe(done.set)
+
+    api.listeners.append(on_call)
+    updates = [make_message_update(i + 1, FIRST_USER_ID + i, '/start') for i in range(args.updates)]
+
+    started = time.perf_counter()
+    rejected = 0
+    if args.mode == 'webhook':
+        url = f'http://127.0.0.1:{webhook_port}/{bot.WEBHOOK_PATH}'
+        rejected = await send_webhook_updates(url, bot.WEBHOOK_SECRET_TOKEN, updates, args.concurrency, sent_at)
+    else:
+        for update in updates:
+            sent_at[update['message']['chat']['id']] = time.perf_counter()
+            api.push_update(update)
+    intake = time.perf_counter() - started
+
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f'timed out with {len(replied_at)} of {args.updates} replies')
+    elapsed = time.perf_counter() - started
+
+    await stop_bot(bot, application)
+    api.stop()
+
+    latencies = [(replied_at[chat_id] - sent_at[chat_id]) * 1000 for chat_id in replied_at]
+    print(f'mode: {args.mode}')
+    print(f'updates: {args.updates}, replies: {len(replied_at)}, rejected: {rejected}')
+    if args.mode == 'webhook':
+        print(f'intake: {intake:.3f}s ({args.updates / intake:.0f} updates/s accepted by the webhook server)')
+    print(f'end to end: {elapsed:.3f}s ({len(replied_at) / elapsed:.0f} updates/s answered)')
+    print(f'reply latency ms: p50 {percentile(latencies, 50):.1f}  p95 {percentile(latencies, 95):.1f}  p99 {percentile(latencies, 99):.1f}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('webhook', 'polling'), default='webhook')
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20, help='parallel webhook requests')
+    parser.add_argument('--api-delay', type=float, default=0.0, help='seconds the fake Bot API takes per send')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--unthrottled', action='store_true', help="lift the bot's outbound rate limits")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()